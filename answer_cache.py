@@ -0,0 +1,184 @@
+#### ------ Semantic answer cache ------ ####
+#
+# Answers are stored per scope (model, knowledge base mode, chat history
+# fingerprint) and looked up by question embedding, so paraphrases of a
+# question already answered in the same scope are served without a COMPLETE
+# call. Entries expire after ttl_secs, the least recently used ones are evicted
+# above max_entries. With a table name the cache is also written to Snowflake
+# and shared by every instance of the app.
+#
+# Answers precomputed by warmup.py for the most asked questions are loaded from
+# precomputed_table with warm(), and reloaded in the background every
+# precomputed_refresh_secs, so they are found like any other cached answer.
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from queries import run
+from stages import get_background_pool
+from vector_index import normalize, parse_vector
+
+
+logger = logging.getLogger(__name__)
+
+
+def history_fingerprint(chat_history):
+    if not chat_history:
+        return ""
+    return hashlib.sha1(chat_history.encode("utf-8")).hexdigest()[:16]
+
+
+def cache_scope(model, knowledge_base, chat_history=""):
+    return f"{model}|kb={int(bool(knowledge_base))}|{history_fingerprint(chat_history)}"
+
+
+class AnswerCache:
+
+    def __init__(self, session=None, table=None, threshold=0.95,
+                 ttl_secs=24 * 3600, max_entries=1000, precomputed_table=None,
+                 precomputed_refresh_secs=3600):
+        self.session = session
+        self.table = table
+        self.threshold = threshold
+        self.ttl_secs = ttl_secs
+        self.max_entries = max_entries
+        self.precomputed_table = precomputed_table
+        self.precomputed_refresh_secs = precomputed_refresh_secs
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()    # (scope, question) -> entry, oldest use first
+        self.hits = 0
+        self.misses = 0
+        self.precomputed = 0
+        self._warmed_at = None
+
+    #### ------ stats ------ ####
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits,
+                "misses": self.misses, "hit_rate": round(self.hit_rate, 4),
+                "precomputed": self.precomputed}
+
+    #### ------ in-memory ------ ####
+
+    def _expired(self, entry, now):
+        return now - entry["created_at"] > self.ttl_secs
+
+    def _local_lookup(self, scope, question, qvec):
+        now = time.time()
+        best, best_sim = None, self.threshold
+        for key, entry in list(self._entries.items()):
+            if self._expired(entry, now):
+                del self._entries[key]
+                continue
+            if key[0] != scope:
+                continue
+            sim = 1.0 if key[1] == question else float(entry["qvec"] @ qvec)
+            if sim >= best_sim:
+                best, best_sim = key, sim
+        if best is None:
+            return None
+        self._entries.move_to_end(best)
+        return self._entries[best]["payload"]
+
+    def _local_put(self, scope, question, qvec, payload, created_at=None):
+        key = (scope, question)
+        self._entries[key] = {"qvec": qvec, "payload": payload,
+                              "created_at": created_at or time.time()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    #### ------ shared table ------ ####
+
+    def _table_lookup(self, scope, qvec):
+        rows = run(self.session, "answer_cache_lookup", json.dumps(qvec.tolist()), scope,
+                   int(self.ttl_secs), self.threshold, table=self.table)
+        if not rows:
+            return None
+        payload = json.loads(rows[0].PAYLOAD)
+        with self._lock:
+            # under the matched question and its own vector, not the one asked
+            self._local_put(scope, rows[0].QUESTION, normalize(parse_vector(rows[0].QVEC)), payload)
+        return payload
+
+    def _table_put(self, scope, question, qvec, payload):
+        run(self.session, "answer_cache_insert", scope, question, json.dumps(qvec.tolist()),
+            json.dumps(payload), table=self.table)
+
+    #### ------ precomputed answers ------ ####
+
+    def _load_precomputed(self):
+        try:
+            rows = run(self.session, "precomputed_load", table=self.precomputed_table)
+        except Exception:
+            return    # best effort, e.g. no warm-up has run yet
+        with self._lock:
+            for row in rows:
+                # knowledge base answers to first questions, without doc search references
+                self._local_put(cache_scope(row.MODEL, True), row.QUESTION,
+                                normalize(parse_vector(row.QVEC)),
+                                {"response": row.RESPONSE, "reference_url": None,
+                                 "pdf_relative_path": row.PDF_RELATIVE_PATH,
+                                 "demo_keyword": None})
+            self.precomputed = len(rows)
+
+    def warm(self):
+        # loads the precomputed answers now the first time, in the background once they are stale
+        if not self.precomputed_table:
+            return self
+        now = time.time()
+        with self._lock:
+            if self._warmed_at is not None and now - self._warmed_at < self.precomputed_refresh_secs:
+                return self
+            first = self._warmed_at is None
+            self._warmed_at = now
+        if first:
+            self._load_precomputed()
+        else:
+            get_background_pool().submit(self._load_precomputed)
+        return self
+
+    #### ------ public ------ ####
+
+    def lookup(self, scope, question, qvec):
+        # returns the cached payload for the question, or None on a miss
+        self.warm()
+        qvec = normalize(parse_vector(qvec))
+        with self._lock:
+            payload = self._local_lookup(scope, question, qvec)
+        if payload is None and self.table:
+            try:
+                payload = self._table_lookup(scope, qvec)
+            except Exception:
+                # the shared cache is best effort, but a failing lookup should not go unnoticed
+                logger.warning("%s lookup failed", self.table, exc_info=True)
+                payload = None
+        with self._lock:
+            if payload is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return payload
+
+    def put(self, scope, question, qvec, payload):
+        # payload must be JSON serializable when a table is configured
+        qvec = normalize(parse_vector(qvec))
+        with self._lock:
+            self._local_put(scope, question, qvec, payload)
+        if self.table:
+            # written in the background, the user already has the answer
+            get_background_pool().submit(self._table_put, scope, question, qvec, payload)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
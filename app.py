@@ -1,23 +1,105 @@
 import streamlit as st 
-from snowflake.snowpark.context import get_active_session
-session = get_active_session() # Get the current credentials
+
+session = None   # Set in main() from get_session(). The benchmark plugs in a fake one
 
 import pandas as pd
 import datetime
+import functools
+import json
 from uuid import uuid4
 
+from answer_cache import AnswerCache, cache_scope
+from completion import CompletionError, CortexCompleter, SqlCompleter
+from context_pruning import prune_chunks
+from conversation_memory import ConversationMemory
+from log_writer import ChatLogWriter
+from model_router import ModelRouter, RoutingLogWriter
+from presign_cache import PresignedUrlCache
+from prompt_budget import PROMPT_INSTRUCTIONS, PromptBudgeter
+from query_analysis import QueryAnalyzer
+from queries import run, server_stats, statement_stats
+from stages import Stage, run_stages
+from tracing import TracedSession, TraceWriter, add_tokens, current_trace, start_trace, trace_span
+from vector_index import VectorIndex
+from vector_partitions import search_partitions
+
+try:
+    from snowflake.snowpark.exceptions import SnowparkSQLException
+    ANSWER_ERRORS = (SnowparkSQLException, CompletionError, TimeoutError)   # a failed query or Cortex call, or a required stage that timed out
+except ImportError:   # no Snowpark, e.g. the offline benchmark
+    ANSWER_ERRORS = (CompletionError, TimeoutError)
+
 pd.set_option("max_colwidth",None)
 
 
 #### ------ Default values for app set up ------ #### 
 
-model_name = 'mistral-7b'   # default but we allow user to select one
-num_chunks = 3    # num-chunks provided as context. Play with this to check how it affects your accuracy
+model_name = 'mistral-7b'   # default but we allow user to select one, or 'auto' to let the model router pick per question
+num_chunks = 3    # max num-chunks provided as context. Play with this to check how it affects your accuracy
+prompt_token_budget = 4000   # max tokens for the final prompt (also capped by the model's context window)
 slide_window = 3    # how many last conversations to remember. This is the slide window.
+rolling_summary = 1   # 1: keep a rolling summary updated in the background instead of summarizing the history before each follow-up
+summary_model = 'mistral-7b'   # small model used for the rolling summary, independent of the chat model
+summary_wait_secs = 2   # how long a follow-up waits for the previous summary update before using the older summary
 debug = 0    # Set this to 1 if you want to see what is the text created as summary and sent to get chunks
 use_chat_history = 1   # 1: Use the chat history by default
 show_token_credits = 0   # 0: Not showing token consumed by default
 knowledge_base = 1   # 1: use knowledge base in addition to live Snowflake doc
+stream_response = 1   # 1: show the answer token by token as it is generated
+analysis_model = 'llama3-8b'   # small model for the query analysis: search query, follow-up retrieval query and demo keyword in one call
+show_demo_link = 1   # 1: show the YouTube demos link under each answer
+
+# in-memory vector index over docs_chunks_table
+index_dtype = 'float16'   # 'float16' or 'int8' (smaller, slightly less precise)
+index_mmap_path = None   # e.g. '/tmp/docs_chunks.npy' to keep the vectors memory-mapped on local disk
+index_ivf_lists = 0   # > 0 to partition the index with k-means (IVF) once the knowledge base gets large
+index_ivf_probes = 4   # number of IVF lists scanned per question
+index_refresh_secs = 300   # how often to check docs_chunks_table for new rows
+
+# or search docs_chunks_table in Snowflake when the knowledge base outgrows the app's memory
+server_index = 0   # 1: partitioned vector search in Snowflake instead of the in-memory index (see partition_docs in setup.sql)
+server_index_probes = 8   # nearest partitions scanned per question, 0 for a full scan
+
+# knowledge base chunks are pruned before the prompt (see context_pruning.py)
+chunk_candidates = 8   # chunks fetched from the vector index, num_chunks of them at most are kept
+min_chunk_similarity = 0.75   # chunks less similar to the question are dropped (the best one is always kept)
+chunk_relative_margin = 0.08   # so are chunks this much less similar than the best one: k adapts to the question
+mmr_lambda = 0.7   # 1: most similar chunks only, lower: more diverse chunks
+
+# retrieval stages run concurrently; these ones give up after a few seconds
+analysis_timeout_secs = 5   # query analysis, falls back to the question itself
+snowdoc_timeout_secs = 8   # live doc search, falls back to knowledge base only context
+index_refresh_timeout_secs = 2   # new rows check of the vector index, falls back to the index as loaded
+
+# semantic answer cache, keyed on model, knowledge base mode and chat history
+answer_cache_threshold = 0.95   # cosine similarity above which two questions share an answer
+answer_cache_ttl_secs = 24 * 3600   # answers older than this are recomputed
+answer_cache_max_entries = 1000   # least recently used answers are evicted above this
+answer_cache_table = None   # 'ANSWER_CACHE' to share cached answers across app instances (see setup.sql)
+precomputed_table = 'PRECOMPUTED_ANSWERS'   # answers to the most asked questions, precomputed by warmup.py (None to skip)
+precomputed_refresh_secs = 3600   # how often to reload them
+
+# presigned urls for the pdf sources
+presign_expiry_secs = 360   # lifetime of a presigned url
+presign_refresh_margin_secs = 60   # never hand out a url with less time left than this
+
+# chat_history_log is written in the background, in batches
+log_max_batch = 50   # flush when this many turns / feedback submits are waiting
+log_flush_secs = 5   # or when the oldest one has waited this long
+
+# model router of the 'auto' model (see model_router.py)
+router_min_quality = 1   # lowest quality level (1..4, see model_quality) an auto answer may come from
+router_max_answer_secs = 10   # latency target: models typically slower than this are avoided
+router_min_confidence = 0.8   # best chunk similarity under which the question needs a stronger model
+router_max_escalations = 1   # times an answer that declined is asked again to the next model up
+routing_log = 1   # 1: log every routing decision with its latency and credits to model_routing (see setup.sql)
+
+# every turn is traced per stage: wall clock, SQL statements, tokens and credits
+trace_persist = 1   # 1: write the spans of every turn to the chat_trace table (see setup.sql), in batches
+show_latency = 0   # 0: Not showing the latency per stage by default
+
+# past turns are re-rendered on every rerun, only the latest ones are shown
+history_page_size = 10   # turns shown, and added per click on 'Show earlier messages'
 
 
 # credits per 1M token from credits consumption table 
@@ -29,508 +111,723 @@ credit_table = {
     'reka-flash': 0.45,
     'mistral-large': 5.1,
     'llama3.1-70b': 1.21,
-    'llama3.1-405b': 5
+    'llama3.1-405b': 5,
+    'llama3-8b': 0.19   # query analysis
+}
+
+# for the model router: quality level (1: simple lookups ... 4: hardest questions) and
+# typical seconds for an answer, rough figures to tune with the model_routing log
+model_quality = {
+    'mistral-7b': 1,
+    'mixtral-8x7b': 2,
+    'reka-flash': 2,
+    'llama3.1-70b': 3,
+    'mistral-large': 3,
+    'llama3.1-405b': 4
+}
+
+model_answer_secs = {
+    'mistral-7b': 3,
+    'mixtral-8x7b': 4,
+    'reka-flash': 5,
+    'llama3.1-70b': 6,
+    'mistral-large': 8,
+    'llama3.1-405b': 12
 }
 
 
 
 #### ------ Helper functions ------ #### 
 
-def get_relevant_context (question):
+@st.cache_resource(show_spinner = False)
+def get_session():
+# looked up once per app process instead of on every rerun; SQL statements are counted per stage
 
-    # obtain live, real time information from Snowflake doc website
+    from snowflake.snowpark.context import get_active_session
+    return TracedSession(get_active_session())
 
-    # query rewrite when initial user query is too long
-    if len(question) > 128:
-        rewrite_query = session.sql(f"""SELECT snowflake.cortex.complete(
-                                          'llama3-8b', 
-                                          'Find the question in the query, rewrite the question so that its length is within 128 characters, and only output the question. query: {question}'
-                                          ) as rewrite_qry;"""
-                               ).to_pandas()['REWRITE_QRY'][0]
-    else:
-        rewrite_query = question
-        
-    # call snowdoc_search to scrape relevant documentation pages
-    df_snowdoc_search = session.sql(f"""SELECT snowdoc_search('{rewrite_query}') AS output,
-                                               output[0] as response,
-                                               output[1] as reference_url """
-                                   ).to_pandas()
-
-    prompt_context = ""
-    
-    if knowledge_base == 1:
-        createsql = f"""
-            create or replace table query_vec(
-                qvec vector(float, 768)
-            )
-        """
-        session.sql(createsql).collect()
-    
-        insertsql = f"""
-            insert into query_vec 
-              select snowflake.cortex.embed_text_768('e5-base-v2', '{question}')
-        """
-    
-        session.sql(insertsql).collect()
-
-        # vector similarity search
-        cmd = f"""
-            with results as
-            (select RELATIVE_PATH,
-                    VECTOR_COSINE_SIMILARITY(docs_chunks_table.chunk_vec, query_vec.qvec) as distance,
-                    chunk
-             from docs_chunks_table, query_vec
-             order by distance desc
-             limit {num_chunks}
-            )
-            select chunk, relative_path from results 
-        """
-    
-        df_chunks = session.sql(cmd).to_pandas()       
-    
-        df_chunks_length = len(df_chunks) -1
-    
-        similar_chunks = ""
-        for i in range (0, df_chunks_length):
-            similar_chunks += df_chunks._get_value(i, 'CHUNK')
 
-        # concatenate knowledge base chunks and snowdoc search result
-        try:
-            prompt_context = similar_chunks + df_snowdoc_search['RESPONSE'][0]
-        except:
-            pass
+# past turns rerun on their own when their feedback widgets change (experimental_fragment on older Streamlit)
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda fn: fn)
+
+
+@st.cache_resource(show_spinner = False)  # loaded once and shared by every user of the app
+def get_vector_index():
+
+    index = VectorIndex(session,
+                        dtype = index_dtype,
+                        mmap_path = index_mmap_path,
+                        ivf_lists = index_ivf_lists,
+                        ivf_probes = index_ivf_probes,
+                        refresh_secs = index_refresh_secs)
+    return index.load()
 
-        # get pdf doc relative_path
-        pdf_relative_path =  df_chunks._get_value(0,'RELATIVE_PATH')
-        cmd2 = f"select GET_PRESIGNED_URL(@docs, '{pdf_relative_path}', 360) as pdf_url from directory(@docs)"
-        df_url_link = session.sql(cmd2).to_pandas()
-        pdf_url_link = df_url_link._get_value(0,'PDF_URL')
-    
-    else:
-        try:
-            prompt_context = df_snowdoc_search['RESPONSE'][0]
-            pdf_relative_path = None
-            pdf_url_link = None
-        except:
-            pass
 
+@functools.lru_cache(maxsize = 1024)  # the answer cache and the retrieval embed the same question
+def embed_question(question):
+# Embed the question with the same model used for the chunks. Plain select, no DDL
 
-    prompt_context = prompt_context.replace("'", "")
+    return run(session, 'embed_question', question)[0].QVEC
 
-    reference_url = df_snowdoc_search['REFERENCE_URL'][0]
+
+@st.cache_resource(show_spinner = False)
+def get_analyzer():
+# search query, follow-up retrieval query and demo keyword in one structured call, cached per question
+
+    return QueryAnalyzer(session, model = analysis_model)
+
+
+def search_snowdoc(search_query):
+# call snowdoc_search to scrape relevant documentation pages (cached per page, see snowdoc_scraper.py)
+
+    output = run(session, 'snowdoc_search', search_query)[0][0]
+    output = json.loads(output) if output else []
+
+    if len(output) < 2:
+        return None, None
+    return output[0], output[1]
+
+
+@st.cache_resource(show_spinner = False)
+def get_presign_cache():
+
+    cache = PresignedUrlCache(session, expiry_secs = presign_expiry_secs,
+                              refresh_margin_secs = presign_refresh_margin_secs)
+    cache.warm()
+    return cache
+
+
+def get_presigned_url(pdf_relative_path):
+# cached per relative path, re-signed before the url expires
+
+    return get_presign_cache().get(pdf_relative_path)
+
+
+def get_relevant_context (question, context = "", retrieval_query = None):
+
+    # obtain live, real time information from Snowflake doc website (analyze -> snowdoc_search)
+    # and from the knowledge base (embed -> vector search -> presign) at the same time.
+    # context is the chat history or rolling summary of a follow-up. Without a retrieval_query,
+    # the query analysis writes one from the context. A slow snowdoc_search degrades to
+    # knowledge-base-only context. top_similarity (best chunk kept) feeds the model router
+    analyzer = get_analyzer()
+    analyze_retrieval = retrieval_query is None and bool(context)
+    fallback = {"search_query": (retrieval_query or question)[:128],
+                "retrieval_query": question,
+                "demo_keyword": question[:128]}
+
+    stages = [
+        Stage('analyze', lambda: analyzer.analyze(question, context, retrieval = analyze_retrieval,
+                                                  demo_keyword = show_demo_link == 1),
+              timeout = analysis_timeout_secs, default = fallback),
+        Stage('snowdoc_search', lambda analysis: search_snowdoc(analysis['search_query']), deps = ['analyze'],
+              timeout = snowdoc_timeout_secs, default = (None, None)),
+    ]
+
+    if knowledge_base == 1:
+        presign_cache = get_presign_cache()
+        num_candidates = max(chunk_candidates, num_chunks)
+        if analyze_retrieval:
+            embed = Stage('embed', lambda analysis: embed_question(analysis['retrieval_query']), deps = ['analyze'])
+        else:
+            embed = Stage('embed', lambda: embed_question(retrieval_query or question))
+        if server_index == 1:
+            # nearest partitions only, in Snowflake
+            stages += [
+                embed,
+                Stage('vector_search', lambda qvec: search_partitions(session, qvec, num_candidates, probes = server_index_probes),
+                      deps = ['embed']),
+            ]
+        else:
+            index = get_vector_index()
+            stages += [
+                # never blocks retrieval: a failed or slow refresh searches the current index
+                Stage('index_refresh', index.refresh, timeout = index_refresh_timeout_secs, default = 0),
+                embed,
+                Stage('vector_search', lambda qvec, _: index.search(qvec, num_candidates, with_vectors = True),
+                      deps = ['embed', 'index_refresh']),
+            ]
+        stages += [
+            Stage('prune', lambda candidates: prune_chunks(candidates, num_chunks,
+                                                           min_similarity = min_chunk_similarity,
+                                                           relative_margin = chunk_relative_margin,
+                                                           mmr_lambda = mmr_lambda),
+                  deps = ['vector_search']),
+            Stage('presign', lambda df_chunks: presign_cache.get(df_chunks['RELATIVE_PATH'].iat[0]) if len(df_chunks) else None,
+                  deps = ['prune']),
+        ]
+
+    with trace_span('retrieval'):
+        results = run_stages(stages).results
+    snowdoc_response, reference_url = results['snowdoc_search']
+
+    if debug == 1:
+        st.text("Query analysis (doc search query, knowledge base query, demo keyword):")
+        st.caption(results['analyze'])
+
+    if knowledge_base == 1:
+        df_chunks = results['prune']
+
+        if debug == 1:
+            st.text(f"Knowledge base chunks kept: {len(df_chunks)} of {len(results['vector_search'])} candidates")
+    
+        similar_chunks = list(df_chunks['CHUNK'])
+        top_similarity = df_chunks['DISTANCE'].max() if len(df_chunks) else None
+
+        # get pdf doc relative_path, none when the knowledge base has nothing for the question
+        pdf_relative_path = df_chunks['RELATIVE_PATH'].iat[0] if len(df_chunks) else None
+        pdf_url_link = results['presign']
+    
+    else:
+        similar_chunks = []
+        top_similarity = None
+        pdf_relative_path = None
+        pdf_url_link = None
+
+    # knowledge base chunks (best first) and snowdoc search result are kept apart,
+    # create_prompt decides how much of each fits
+    doc_pages = snowdoc_response or ""
              
-    return prompt_context, reference_url, pdf_relative_path, pdf_url_link
+    return similar_chunks, doc_pages, reference_url, pdf_relative_path, pdf_url_link, top_similarity
 
 
-def get_chat_history():
-#Get the history from the st.session_stage.messages according to the slide window parameter
+def get_chat_history_turns():
+#Get the history from the st.session_stage.messages according to the slide window parameter, one entry per message
     
-    chat_history = ""
+    chat_history = []
     
     start_index = max(0, len(st.session_state.messages) - slide_window)
     for i in range (start_index , len(st.session_state.messages) -1):
         role = st.session_state.messages[i]["role"]
         content = st.session_state.messages[i]["content"]
-        chat_history += f"[{role}] : {content} "
+        chat_history.append(f"[{role}] : {content} ")
 
     return chat_history
 
-    
-def summarize_question_with_history(chat_history, question):
-# To get the right context, use the LLM to first summarize the previous conversation
-# This will be used to get embeddings and find similar chunks in the docs for context
-# that extend the question
-    
-    prompt = f"""
-        '
-        Based on the chat history below and the question, generate a query 
-        with the chat history provided. Stay high level. Do not be too specific.
-        The query should be in natual language. Output query should be less than 20 words. 
-        
-        CHAT HISTORY: {chat_history}
-        QUESTION: {question}'
-        """
-
-    prompt = prompt.replace("'", "")
-    
-    cmd = """SELECT SNOWFLAKE.CORTEX.COMPLETE('%s',
-                                              [{'role': 'user',
-                                                'content': '%s'}],
-                                              {}
-                        ) as output,
-                    TRIM(GET(output:choices,0):messages,'" ') as response,
-                    output:usage:total_tokens::int as total_tokens;
-          """ % (model_name, prompt)
-    
-    response = session.sql(cmd).collect()
-    summary = response[0].RESPONSE
-    summary_tot_tokens = response[0].TOTAL_TOKENS
-
-    if debug ==1:
-        st.text("Prompt used to generate summary:")
-        st.caption(prompt)
-        st.text("Summary used to find similar chunks in the docs:")
-        st.caption(sumary)
 
-    summary = summary.replace("'", "")
+def get_chat_history():
 
-    return summary, summary_tot_tokens
+    return "".join(get_chat_history_turns())
 
 
 def create_prompt (question):
 
     if use_chat_history == 1:
-        chat_history = get_chat_history()
-
-        if chat_history != "": #There is chat_history, so not first question
-            question_summary, summary_tot_tokens = summarize_question_with_history(chat_history, question)
-            prompt_context, reference_url, pdf_relative_path, pdf_url_link =  get_relevant_context(question_summary)
+        history_turns = get_chat_history_turns()
+
+        if history_turns and rolling_summary == 1: #Follow-up: retrieve with the rolling summary, no LLM call first
+            with trace_span('summary'):
+                summary_tot_tokens = get_memory().take_tokens()   # spent updating the summary after the last answer
+                add_tokens(summary_tot_tokens, summary_model)
+                summary = get_memory().current_summary(wait_secs = summary_wait_secs)
+                retrieval_query = get_memory().retrieval_query(question, wait_secs = 0)
+            similar_chunks, doc_pages, reference_url, pdf_relative_path, pdf_url_link, top_similarity = get_relevant_context(
+                question, context = summary, retrieval_query = retrieval_query)
+        elif history_turns: #There is chat_history, so not first question. The query analysis writes the retrieval query
+            similar_chunks, doc_pages, reference_url, pdf_relative_path, pdf_url_link, top_similarity = get_relevant_context(
+                question, context = "".join(history_turns))
+            summary_tot_tokens = 0
         else:
-            prompt_context, reference_url, pdf_relative_path, pdf_url_link = get_relevant_context(question) #First question when using history
+            similar_chunks, doc_pages, reference_url, pdf_relative_path, pdf_url_link, top_similarity = get_relevant_context(question) #First question when using history
             summary_tot_tokens = 0
     else:
-        prompt_context, reference_url, pdf_relative_path, pdf_url_link = get_relevant_context(question)
-        chat_history = ""
+        similar_chunks, doc_pages, reference_url, pdf_relative_path, pdf_url_link, top_similarity = get_relevant_context(question)
+        history_turns = []
         summary_tot_tokens = 0
+
+    # the 'auto' model is picked now that the retrieval confidence is known
+    if model_name == 'auto':
+        route = get_router().route(question, confidence = top_similarity, doc_pages = bool(doc_pages))
+    else:
+        route = get_router().fixed(model_name)
+    route["context_found"] = bool(similar_chunks or doc_pages)
+
+    # fit history, chunks and doc pages into the model's token budget
+    budgeter = PromptBudgeter(route["model"], max_prompt_tokens = prompt_token_budget)
+    chat_history, prompt_context, prompt_tokens = budgeter.fit(
+        PROMPT_INSTRUCTIONS, question, history_turns, similar_chunks, doc_pages)
   
-    prompt = f"""
-          'You are an Snowflake expert chat assistance that extracts information from the CONTEXT provided.
-           You offer a chat experience considering the information included in the CHAT HISTORY.
-           When ansering the question be concise, structured and do not hallucinate. 
-           If you don´t have the information just say so.
-           
-           Do not mention the CONTEXT used in your answer.
-           Do not mention the CHAT HISTORY used in your asnwer.
-           
+    prompt = PROMPT_INSTRUCTIONS + f"""
           CHAT HISTORY: {chat_history}
           CONTEXT: {prompt_context}, 
           QUESTION:  
            {question} 
-           Answer: '
+           Answer: 
            """
 
-    return prompt, reference_url, pdf_relative_path, pdf_url_link, summary_tot_tokens
+    return prompt, reference_url, pdf_relative_path, pdf_url_link, summary_tot_tokens, prompt_tokens, route
 
 
-@st.cache_data(show_spinner = False)  #reuse result if repeat query
-def complete(question):
+@st.cache_resource(show_spinner = False)
+def get_router():
 
-    prompt, reference_url, pdf_relative_path, pdf_url_link, summary_tot_tokens = create_prompt(question)
+    return ModelRouter(credit_table, model_quality, model_answer_secs,
+                       min_quality = router_min_quality,
+                       max_answer_secs = router_max_answer_secs,
+                       min_confidence = router_min_confidence,
+                       max_escalations = router_max_escalations)
 
-    prompt = prompt.replace("'","")
 
-    cmd = """SELECT SNOWFLAKE.CORTEX.COMPLETE('%s',
-                                              [{'role': 'user',
-                                                'content': '%s'}],
-                                              {}
-                        ) as output,
-                    TRIM(GET(output:choices,0):messages,'" ') as response,
-                    output:usage:total_tokens::int as total_tokens;
-          """ % (model_name, prompt)
-    
-    df_response = session.sql(cmd).collect()
-    return df_response, reference_url, pdf_relative_path, pdf_url_link, summary_tot_tokens
+@st.cache_resource(show_spinner = False)
+def get_completer():
+# Streaming Cortex API when available, otherwise the single COMPLETE query
 
+    if stream_response == 1:
+        try:
+            return CortexCompleter(session)
+        except ImportError:
+            pass
+    return SqlCompleter(session)
 
-def reset_conversation():
-    st.session_state.messages = []
 
-def expander_state():
-    st.session_state.expand = True
+@st.cache_resource(show_spinner = False)
+def get_answer_cache():
 
+    cache = AnswerCache(session,
+                        table = answer_cache_table,
+                        threshold = answer_cache_threshold,
+                        ttl_secs = answer_cache_ttl_secs,
+                        max_entries = answer_cache_max_entries,
+                        precomputed_table = precomputed_table,
+                        precomputed_refresh_secs = precomputed_refresh_secs)
+    return cache.warm()
 
 
-####  ------ MAIN CODE ------ ####
+def complete(question, on_token = None):
+# on_token(text_so_far) is called as tokens arrive. Answers are reused for near-duplicate
+# questions asked with the same model, knowledge base mode and chat history
 
-#def main():
-st.title("❄️ SnowChat for Snowflake Doc")
-st.caption(
-    f"""Hi! 
-    I'm a chatbot to help answer any product questions you may have about Snowflake.
-    """)    
+    chat_history = get_chat_history() if use_chat_history == 1 else ""
+    scope = cache_scope(model_name, knowledge_base, chat_history)
+    with trace_span('embed'):
+        qvec = embed_question(question)
 
-st.write(' ')   # create additional row space 
+    with trace_span('answer_cache'):
+        cached = get_answer_cache().lookup(scope, question, qvec)
+    if cached is not None:
+        # presigned urls expire, only the path is cached
+        pdf_relative_path = cached["pdf_relative_path"]
+        with trace_span('presign'):
+            pdf_url_link = get_presigned_url(pdf_relative_path) if pdf_relative_path else None
+        get_analyzer().remember(question, cached.get("demo_keyword"))
+        return cached["response"], 0, cached["reference_url"], pdf_relative_path, pdf_url_link, 0, None
 
-with st.expander("Configure options"):
-    # Give user the option to select model
-    model_name = st.selectbox('Select desired model:',('mistral-7b', 'mixtral-8x7b', 'reka-flash', 'mistral-large', 'llama3.1-70b', 'llama3.1-405b'), index = 0)
-    
-    # For educational purposes. Users can chech the difference when using memory or not
-    use_chat_history = st.toggle('Remember the chat history', value = True)
+    prompt, reference_url, pdf_relative_path, pdf_url_link, summary_tot_tokens, prompt_tokens, route = create_prompt(question)
 
-    # Users can choose to use knowledge base in addition to live Snowflake doc
-    knowledge_base = st.toggle('Use knowledge base as source in addition to live Snowflake doc', value = True)
+    model = route["model"]
+    notice = ""
+    while model is not None:
+        with trace_span('complete') as span:
+            stream = get_completer().stream(model, prompt)
+            res_text = ""
+            for token in stream:
+                res_text += token
+                if on_token is not None:
+                    on_token(notice + res_text)
+            add_tokens(stream.total_tokens, model)
+        get_router().charge(route, stream.total_tokens, model, span.duration if span else 0)
+        # an auto answer that declined with context at hand is asked again to the next model up,
+        # and the user is told the text they just saw is being replaced
+        model = get_router().escalate(route, stream.text, route["context_found"])
+        if model is not None:
+            notice = f"_{route['escalated_from']} could not answer this one, asking {model}..._\n\n"
+            if on_token is not None:
+                on_token(notice)
 
-    # Users can choose to show tokens and credits or not
-    show_token_credits = st.toggle('Show total tokens and credits consumed per query', value = False)
-    
-    # User can select debug mode
-    #debug = st.toggle('Debug mode: Click to see summary generated of previous conversation')
+    trace = current_trace()
+    if routing_log == 1 and trace is not None:
+        get_routing_writer().log_decision(trace.session_id, trace.query_seq, route)
+    st.session_state.last_route = route
 
-# Log current user
-user_name = st.experimental_user.user_name
+    get_answer_cache().put(scope, question, qvec, {
+        "response": stream.text,
+        "reference_url": reference_url,
+        "pdf_relative_path": None if pdf_relative_path is None else str(pdf_relative_path),
+        "demo_keyword": get_analyzer().keyword(question)
+    })
 
-st.write(' ')
-st.write(' ')
+    return stream.text, stream.total_tokens, reference_url, pdf_relative_path, pdf_url_link, summary_tot_tokens, prompt_tokens
 
 
-# Initialize chat history
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-    
+@st.cache_resource(show_spinner = False)
+def get_log_writer():
 
-# Initialize session id and query sequence
-if len(st.session_state.messages) == 0:
-    st.session_state.id = str(uuid4())
+    return ChatLogWriter(session, max_batch = log_max_batch, flush_secs = log_flush_secs)
 
-# Initialize with sample queries.
-init_placeholder = st.empty()
 
-if len(st.session_state.messages) == 0:
-    with init_placeholder.container():
-        st.write(' ')
-        st.write(' ')
+@st.cache_resource(show_spinner = False)
+def get_trace_writer():
 
-        st.caption('Try searching:')
-        st.text(' - What is unique about Snowflake architecture?')
-        st.text(' - Is hybrid table available in Azure?')
-        st.text(' - List out all Cortex LLM functions and available models')
-        st.text(' - Compare dynamic table with streams and tasks')
-        st.text(' - Give me an example of how to use the Cortex Anomaly Detection function')
-
-
-else:
-    # Display chat messages from history on app rerun
-    for message in st.session_state.messages:
-        
-        if message["role"] == 'user':
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
-        else:
-            with st.chat_message(message["role"], avatar = "❄️"):
-                st.markdown(message["content"])
-                st.write(' ')
-                st.markdown(message["reference"])
-                st.write(' ')
-                st.markdown(":snowboarder: Check out relevant product [demos](%s) (right click and open in a new tab)." % message["demo"])
-    
-                # show tokens and credits
-                if show_token_credits:
-                    st.write(' ')
-                    st.caption(message["token"])
-    
-                if message["suggestion"]:
-                    suggestion = message["suggestion"]
-                else:
-                    suggestion = "Suggest an alternative answer"
-    
-    
-            with st.expander("Provide feedback", expanded=st.session_state.expand):
-                
-                st.caption("Do you like this response? Feel free to suggest an alternative answer either way.")
-                
-                with st.container():
-                    col1, _, col3 = st.columns([4, 0.5, 12])
-                
-                    with col1:
-                        st.write('<div style="height: 20px;"> </div>', unsafe_allow_html=True)
-                        feedback = st.select_slider(
-                            '',
-                            options=['Yes', 'Neutral', 'No'],
-                            value = message["slider"],
-                            key = message["slider_key"],
-                            on_change = expander_state
-                        )
-                        
-                    with col3:
-                        suggest_input = st.text_area("", placeholder=suggestion, height=80, key = message["text_key"])
-    
-                with st.container():
-                    col1, col2 = st.columns([7, 1])                   
-                    with col2:
-                        # Submit button to overwrite feedback and suggestion
-                        if st.button('Submit', key = message["submit_key"]):
-                            suggest_input = suggest_input.replace("'", "")
-                            insert_cmd = f"""
-                                   UPDATE CHAT_HISTORY_LOG
-                                     SET FEEDBACK = '{feedback}', SUGGESTION = '{suggest_input}'
-                                     WHERE SESSION_ID = '{message["session_id"]}'
-                                     AND QUERY_SEQ = {message["query_seq"]}
-                                   """
-                            session.sql(insert_cmd).collect()
-                            st.toast("✅ Feedback Submitted!")
-                        
-
-
-# Accept user input
-if question := st.chat_input("Type your question about Snowflake"): 
-
-    init_placeholder.empty()
-
-    # Display user message in chat message container
-    with st.chat_message("user"):
-        st.markdown(question)
-    
-        
-    # Display assistant response in chat message container
-    with st.chat_message("assistant", avatar = "❄️"):
+    return TraceWriter(session, flush_secs = log_flush_secs)
 
-        with st.spinner("I'm thinking. Please wait..."):
-            message_placeholder = st.empty()
 
-            question = question.replace("'","")
+@st.cache_resource(show_spinner = False)
+def get_routing_writer():
 
-            try:
-                response, reference_url, pdf_relative_path, pdf_url_link, summary_tot_tokens = complete(question)
-            except:
-                st.markdown(':red[Max Tokens exceeded. Please click on start over button to free up chat history!]')
-                st.button('Start Over', on_click=reset_conversation, key = str(uuid4()))
-                
+    return RoutingLogWriter(session, max_batch = log_max_batch, flush_secs = log_flush_secs)
 
-        # show response
-        res_text = response[0].RESPONSE
-        message_placeholder.markdown(res_text)
-        #st.markdown(res_text)
-        
-        tot_tokens = response[0].TOTAL_TOKENS
 
-        tot_tokens = tot_tokens + summary_tot_tokens
-        
-        res_text = res_text.replace("'", "")
+def latency_panel(latency):
+# per-stage breakdown of one turn: wall clock, SQL statements, tokens and credits
 
+    turn = latency[0]
+    with st.expander(f"Latency: {turn['ms'] / 1000:.1f}s, {sum(row['sql'] for row in latency)} SQL statements"):
+        st.dataframe(pd.DataFrame(latency), hide_index = True, use_container_width = True)
 
-        # show reference url and pdf relative path
-        if (reference_url is not None) and (knowledge_base == 1):
-            st.write(' ')
-            reference_url = reference_url.replace('"', '').split(',')
-            display_url = f""":book: Sources:  
-            1) {reference_url[0]}  
-            2) {reference_url[1]}  
-            3) [{pdf_relative_path}]({pdf_url_link})"""
-        elif (reference_url is not None) and (knowledge_base == 0):
-            st.write(' ')
-            reference_url = reference_url.replace('"', '').split(',')
-            display_url = f""":book: Sources:  
-            1) {reference_url[0]}  
-            2) {reference_url[1]}"""
-        elif knowledge_base:
-            display_url = f""":book: Sources:  
-            1) [{pdf_relative_path}]({pdf_url_link})"""            
-        else:
-            display_url = ''
-
-        st.markdown(display_url)
-
-        
-        # show youtube demos
-        
-        # rewrite query to extract key words for more effective searching
-        if len(question) > 128:
-            rewrite_query = session.sql(f"""SELECT snowflake.cortex.complete(
-                                          'llama3-70b', 
-                                          'Is there a relevant Snowflake key feature, use case or workload that is mentioned directly in the query? 
-                                           If yes, return the name of the feature, use case or workload. 
-                                           If not, say no. Be extremely concise and only answer the question as instructed.  
-                                           Query: {question}'
-                                          ) as rewrite_qry;"""
-                               ).to_pandas()['REWRITE_QRY'][0]
-        else:
-            rewrite_query = question
 
-        # display 
+def get_memory():
+# rolling summary of this user's conversation
+
+    if "memory" not in st.session_state:
+        st.session_state.memory = ConversationMemory(model = summary_model)
+    return st.session_state.memory
+
+
+def reset_conversation():
+    st.session_state.messages = []
+    st.session_state.pop("memory", None)
+    st.session_state.pop("visible_messages", None)
+
+def expander_state(index):
+    st.session_state.messages[index]["expand"] = True
+
+def show_earlier_messages():
+    st.session_state.visible_messages = st.session_state.get("visible_messages", 2 * history_page_size) + 2 * history_page_size
+
+
+def show_message(message):
+# a past turn, as it was shown when answered
+
+    if message["role"] == 'user':
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+        return
+
+    with st.chat_message(message["role"], avatar = "❄️"):
+        st.markdown(message["content"])
         st.write(' ')
-        youtube_url = "https://www.youtube.com/@snowflakedevelopers/search?query=%s" % rewrite_query.replace('?', '').replace(':', '').replace('\n', '%20').replace(' ', '%20')
-        st.markdown(":snowboarder:  Check out relevant product [demos](%s) (right click and open in a new tab)." % youtube_url)
+        st.markdown(message["reference"])
+        if message.get("escalation"):
+            st.caption(message["escalation"])
+        st.write(' ')
+        if message["demo"]:
+            st.markdown(":snowboarder: Check out relevant product [demos](%s) (right click and open in a new tab)." % message["demo"])
 
-        
         # show tokens and credits
-        display_token = f"""Total tokens: {tot_tokens}. 
-                            Total credits: {round(tot_tokens * credit_table[model_name] / 1000000, 6)}
-                        """
         if show_token_credits:
             st.write(' ')
-            st.caption(display_token)
-        else:
-            pass
+            st.caption(message["token"])
 
+        if show_latency and message.get("latency"):
+            latency_panel(message["latency"])
 
-    # Control query sequence in a session
-    if len(st.session_state.messages) == 0:
-        st.session_state.query_seq = 1
+
+@fragment
+def show_feedback(index):
+# feedback widgets of one answer. Moving the slider or submitting only reruns this block
+
+    message = st.session_state.messages[index]
+
+    if message["suggestion"]:
+        suggestion = message["suggestion"]
     else:
-        st.session_state.query_seq += 1
-    
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": question, "reference": ''})
+        suggestion = "Suggest an alternative answer"
 
-    
-    
-    # Response evaluation
-    with st.expander("Provide feedback", expanded=False):
+    with st.expander("Provide feedback", expanded = message.get("expand", False)):
 
-        st.session_state.expand = False
-        
         st.caption("Do you like this response? Feel free to suggest an alternative answer either way.")
-        
+
         with st.container():
             col1, _, col3 = st.columns([4, 0.5, 12])
-        
+
             with col1:
-                slider_key = str(uuid4())
-                
                 st.write('<div style="height: 20px;"> </div>', unsafe_allow_html=True)
                 feedback = st.select_slider(
                     '',
                     options=['Yes', 'Neutral', 'No'],
-                    value = 'Neutral',
-                    key = slider_key,
-                    on_change = expander_state
+                    value = message["slider"],
+                    key = message["slider_key"],
+                    on_change = expander_state,
+                    args = (index,)
                 )
-                
+
             with col3:
-                text_key = str(uuid4())
-                suggest_input = st.text_area("", placeholder="Suggest an alternative answer", height=80, key = text_key)
+                suggest_input = st.text_area("", placeholder=suggestion, height=80, key = message["text_key"])
 
-            with st.container():
-                col1, col2 = st.columns([7, 1])                   
-                with col2:
-                    submit_key = str(uuid4())
-                    st.button('Submit', key = submit_key)
+        with st.container():
+            col1, col2 = st.columns([7, 1])
+            with col2:
+                # Submit button to overwrite feedback and suggestion
+                if st.button('Submit', key = message["submit_key"]):
+                    get_log_writer().log_feedback(message["session_id"], message["query_seq"],
+                                                  feedback, suggest_input)
+                    message["slider"], message["suggestion"] = feedback, suggest_input
+                    st.toast("✅ Feedback Submitted!")
 
-    
-    st.session_state.messages.append({"role": "assistant",
-                                      "session_id": st.session_state.id,
-                                      "query_seq": st.session_state.query_seq,
-                                      "content": res_text, 
-                                      "reference": display_url,
-                                      "demo": youtube_url,
-                                      "token": display_token,
-                                      "slider_key": slider_key,
-                                      "text_key": text_key,
-                                      "submit_key": submit_key,
-                                      "slider": feedback,
-                                      "suggestion": suggest_input
-                                     })
 
-    
+# named statements of the question pipeline, with their compile / execution time in debug mode
+PIPELINE_STATEMENTS = ['embed_question', 'analyze_question', 'snowdoc_search',
+                       'chat_complete', 'count_tokens', 'presign_path']
+
+
+
+####  ------ MAIN CODE ------ ####
+
+def main():
+
+    global session, model_name, use_chat_history, knowledge_base, show_token_credits, show_latency, debug
+
+    session = get_session() # Get the current credentials, once per process
+
+    st.title("❄️ SnowChat for Snowflake Doc")
+    st.caption(
+        f"""Hi! 
+        I'm a chatbot to help answer any product questions you may have about Snowflake.
+        """)    
+
+    st.write(' ')   # create additional row space 
+
+    with st.expander("Configure options"):
+        # Give user the option to select model
+        model_name = st.selectbox('Select desired model:',('mistral-7b', 'mixtral-8x7b', 'reka-flash', 'mistral-large', 'llama3.1-70b', 'llama3.1-405b', 'auto'), index = 0)
+
+        # For educational purposes. Users can chech the difference when using memory or not
+        use_chat_history = st.toggle('Remember the chat history', value = True)
+
+        # Users can choose to use knowledge base in addition to live Snowflake doc
+        knowledge_base = st.toggle('Use knowledge base as source in addition to live Snowflake doc', value = True)
+
+        # Users can choose to show tokens and credits or not
+        show_token_credits = st.toggle('Show total tokens and credits consumed per query', value = False)
+
+        # Users can see where the seconds, SQL statements and credits of each query go
+        show_latency = st.toggle('Show latency per stage for each query', value = False)
+
+        # User can select debug mode
+        debug = st.toggle('Debug mode: Click to see summary generated of previous conversation')
+
+    # Log current user, looked up once per browser session
+    if "user_name" not in st.session_state:
+        st.session_state.user_name = st.experimental_user.user_name
+    user_name = st.session_state.user_name
+
+    st.write(' ')
+    st.write(' ')
+
+
+    # Initialize chat history
+    if "messages" not in st.session_state:
+        st.session_state.messages = []
+
+
+    # Initialize session id and query sequence
+    if len(st.session_state.messages) == 0:
+        st.session_state.id = str(uuid4())
+
+    # Initialize with sample queries.
+    init_placeholder = st.empty()
+
+    if len(st.session_state.messages) == 0:
+        with init_placeholder.container():
+            st.write(' ')
+            st.write(' ')
+
+            st.caption('Try searching:')
+            st.text(' - What is unique about Snowflake architecture?')
+            st.text(' - Is hybrid table available in Azure?')
+            st.text(' - List out all Cortex LLM functions and available models')
+            st.text(' - Compare dynamic table with streams and tasks')
+            st.text(' - Give me an example of how to use the Cortex Anomaly Detection function')
+
+
+    else:
+        # Display chat messages from history on app rerun, the latest turns only so a
+        # rerun costs the same however long the conversation gets
+        messages = st.session_state.messages
+        first = max(0, len(messages) - st.session_state.get("visible_messages", 2 * history_page_size))
+        if first > 0:
+            st.button(f"Show earlier messages ({first // 2} more)", on_click = show_earlier_messages)
+
+        for index in range(first, len(messages)):
+            show_message(messages[index])
+            if messages[index]["role"] == 'assistant':
+                show_feedback(index)
+
+
+
+    # Accept user input
+    if question := st.chat_input("Type your question about Snowflake"): 
+
+        init_placeholder.empty()
+
+        # Control query sequence in a session
+        if len(st.session_state.messages) == 0:
+            st.session_state.query_seq = 1
+        else:
+            st.session_state.query_seq += 1
+
+        # trace this turn stage by stage, until the log write
+        trace = start_trace(st.session_state.id, st.session_state.query_seq, credit_table)
+
+        # Display user message in chat message container
+        with st.chat_message("user"):
+            st.markdown(question)
+
+
+        # Display assistant response in chat message container
+        with st.chat_message("assistant", avatar = "❄️"):
+
+            with st.spinner("I'm thinking. Please wait..."):
+                message_placeholder = st.empty()
+
+                try:
+                    res_text, tot_tokens, reference_url, pdf_relative_path, pdf_url_link, summary_tot_tokens, prompt_tokens = complete(
+                        question, on_token = lambda text: message_placeholder.markdown(text + "▌"))
+                except ANSWER_ERRORS as e:
+                    # the prompt is budgeted, so this is a failed query or a stage that timed out
+                    message_placeholder.markdown(f':red[Sorry, this question could not be answered: {e}]')
+                    st.button('Start Over', on_click=reset_conversation, key = str(uuid4()))
+                    trace.root.status = 'error'
+                    trace.finish()
+                    if trace_persist == 1:
+                        get_trace_writer().write_trace(trace)
+                    st.stop()
+
+
+            # show response
+            message_placeholder.markdown(res_text)
+            #st.markdown(res_text)
+
+            # answer, summary and query analysis tokens, each billed at the rate of the model that produced it
+            tot_tokens = trace.tokens
+            tot_credits = trace.credits
+            route = st.session_state.pop("last_route", None)   # None for a cached answer
+
+            # fold this exchange into the rolling summary in the background, ready for the next question
+            if use_chat_history and rolling_summary == 1:
+                get_memory().update_async(session, question, res_text)
+
+
+            # show reference url and pdf relative path (none when the knowledge base had nothing for the question)
+            has_pdf = (knowledge_base == 1) and (pdf_relative_path is not None)
+            if (reference_url is not None) and has_pdf:
+                st.write(' ')
+                reference_url = reference_url.replace('"', '').split(',')
+                display_url = f""":book: Sources:  
+                1) {reference_url[0]}  
+                2) {reference_url[1]}  
+                3) [{pdf_relative_path}]({pdf_url_link})"""
+            elif reference_url is not None:
+                st.write(' ')
+                reference_url = reference_url.replace('"', '').split(',')
+                display_url = f""":book: Sources:  
+                1) {reference_url[0]}  
+                2) {reference_url[1]}"""
+            elif has_pdf:
+                display_url = f""":book: Sources:  
+                1) [{pdf_relative_path}]({pdf_url_link})"""            
+            else:
+                display_url = ''
+
+            st.markdown(display_url)
+
+            if route and route["escalated_from"]:
+                escalation = f"Answered by {route['model']}: {route['escalated_from']} could not answer this question."
+                st.caption(escalation)
+            else:
+                escalation = None
+
+
+            # show youtube demos, searched with the key feature found by the query analysis (no extra call)
+            if show_demo_link == 1:
+                demo_keyword = get_analyzer().keyword(question)
+                st.write(' ')
+                youtube_url = "https://www.youtube.com/@snowflakedevelopers/search?query=%s" % demo_keyword.replace('?', '').replace(':', '').replace('\n', '%20').replace(' ', '%20')
+                st.markdown(":snowboarder:  Check out relevant product [demos](%s) (right click and open in a new tab)." % youtube_url)
+            else:
+                youtube_url = None
+
+
+            # show tokens and credits
+            display_token = f"""Total tokens: {tot_tokens}. 
+                                Total credits: {round(tot_credits, 6)}. 
+                                Answer cache hit rate: {get_answer_cache().hit_rate:.0%}
+                            """
+            if route and route["mode"] == 'auto':
+                display_token += f"""  
+                                Model: {route['model']} ({route['reason']})
+                            """
+            if prompt_tokens:
+                display_token += f"""  
+                                Prompt tokens (estimated): {prompt_tokens['total']} of {prompt_tokens['budget']} 
+                                (history {prompt_tokens['history']}, chunks {prompt_tokens['chunks']}, doc pages {prompt_tokens['doc_pages']})
+                            """
+            if show_token_credits:
+                st.write(' ')
+                st.caption(display_token)
+            else:
+                pass
+
+
+        # Add user message to chat history
+        st.session_state.messages.append({"role": "user", "content": question, "reference": ''})
+
+
+
+        # Response evaluation, the same feedback widgets as past turns
+        slider_key, text_key, submit_key = str(uuid4()), str(uuid4()), str(uuid4())
+        feedback, suggest_input = 'Neutral', ''
+
+        st.session_state.messages.append({"role": "assistant",
+                                          "session_id": st.session_state.id,
+                                          "query_seq": st.session_state.query_seq,
+                                          "content": res_text, 
+                                          "reference": display_url,
+                                          "demo": youtube_url,
+                                          "token": display_token,
+                                          "slider_key": slider_key,
+                                          "text_key": text_key,
+                                          "submit_key": submit_key,
+                                          "slider": feedback,
+                                          "suggestion": suggest_input,
+                                          "escalation": escalation
+                                         })
+        show_feedback(len(st.session_state.messages) - 1)
+
+
+
+        # Queue query and response for the chat_history_log table, written in batches in the background
+        with trace_span('log_write'):
+            get_log_writer().log_turn(st.session_state.id, st.session_state.query_seq, user_name,
+                                      question, res_text, feedback, suggest_input)
+
+        trace.finish()
+        st.session_state.messages[-1]["latency"] = trace.breakdown()
+        if trace_persist == 1:
+            get_trace_writer().write_trace(trace)
+        if show_latency:
+            latency_panel(st.session_state.messages[-1]["latency"])
 
-    # Write query and response back to chat_history_log table
-    ts = session.sql("SELECT CURRENT_TIMESTAMP(0) :: varchar as ts").to_pandas()['TS'][0]
-    df = pd.DataFrame({"TIMESTAMP": [ts], "SESSION_ID": [st.session_state.id], "QUERY_SEQ": [st.session_state.query_seq]
-                       , "USER_NAME": [user_name], "QUERY": [question], "RESPONSE": [res_text]
-                       , "FEEDBACK": [feedback], "SUGGESTION": [suggest_input]})
-    session.write_pandas(df, "CHAT_HISTORY_LOG")
 
+    st.write(' ')
+    st.write(' ')
 
-st.write(' ')
-st.write(' ')
 
+    # start over button
+    if st.session_state.messages:
+        st.button('Start Over', on_click=reset_conversation, key = str(uuid4()))
 
-# start over button
-if st.session_state.messages:
-    st.button('Start Over', on_click=reset_conversation, key = str(uuid4()))
+    if debug == 1:
+        st.caption(f"Chat log writer: {get_log_writer().stats()}")
+        st.caption(f"Chat trace writer: {get_trace_writer().stats()}")
+        st.caption(f"Model router: {get_router().stats()}")
+        st.caption(f"Query analysis: {get_analyzer().stats()}")
+        st.caption(f"SQL statements (client side): {statement_stats()}")
+        # a query of its own, only when asked for so debug reruns stay cheap
+        if st.button('Compile / execution time from query history'):
+            st.caption(f"SQL statements (query history): {server_stats(session, PIPELINE_STATEMENTS, stage = '@docs')}")
 
 
 
-# if __name__== '__main__':
-#     main()
+if __name__== '__main__':
+    main()
@@ -0,0 +1,114 @@
+#### ------ Headless batch question answering ------ ####
+#
+# Answers a table or file of questions with the knowledge base, set-based,
+# in a handful of statements whatever the number of questions:
+#
+#   1. load + embed      one CREATE TABLE AS SELECT with embed_text_768
+#   2. retrieve top-k    one similarity join with a row_number() window
+#   3. answer            one INSERT ... SELECT with SNOWFLAKE.CORTEX.COMPLETE
+#                        per row into the results table (BATCH_ANSWERS, see setup.sql)
+#
+# so throughput scales with the warehouse instead of client round-trips. Use it
+# to regression-test answers after doc uploads or to pre-answer support
+# tickets. Live doc search and chat history are not part of a batch.
+#
+#   python batch_qa.py --questions-table SUPPORT_QUESTIONS --model mistral-large
+#   python batch_qa.py --questions-file questions.txt --connection my_conn
+#
+# Files are .txt (one question per line), .jsonl ({"question": ..., "id": ...})
+# or .csv (a question column and an optional id column).
+
+import argparse
+import csv
+import json
+import sys
+import time
+from uuid import uuid4
+
+from prompt_budget import PROMPT_INSTRUCTIONS
+from queries import run
+
+
+def read_questions(path):
+    # [(question_id, question)] from a .txt, .jsonl or .csv file
+    rows = []
+    with open(path, newline='') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    rows.append((item.get('id'), item['question']))
+        elif path.endswith('.csv'):
+            for item in csv.DictReader(f):
+                rows.append((item.get('id'), item['question']))
+        else:
+            rows = [(None, line.strip()) for line in f if line.strip()]
+    return [(str(qid) if qid is not None else str(n), q) for n, (qid, q) in enumerate(rows, start=1)]
+
+
+def run_batch(session, questions=None, questions_table=None, question_column='QUESTION',
+              id_column=None, model='mistral-7b', num_chunks=3, context_chars=12000,
+              chunks_table='DOCS_CHUNKS_TABLE', results_table='BATCH_ANSWERS', run_id=None):
+    # questions: [(question_id, question)]; or questions_table with question_column (and id_column)
+    run_id = run_id or str(uuid4())
+    timings = {}
+
+    start = time.perf_counter()
+    if questions_table:
+        run(session, 'batch_load_table', source=questions_table, question_column=question_column,
+            id_column=id_column or f"row_number() over (order by {question_column})")
+    else:
+        run(session, 'batch_load_rows', json.dumps([[qid, q] for qid, q in questions]))
+    timings['load_embed_secs'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run(session, 'batch_retrieve', num_chunks, chunks_table=chunks_table)
+    timings['retrieve_secs'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run(session, 'batch_complete', context_chars, model, PROMPT_INSTRUCTIONS, run_id, model,
+        table=results_table)
+    timings['complete_secs'] = time.perf_counter() - start
+
+    summary = run(session, 'batch_summary', run_id, table=results_table)[0]
+    return {"run_id": run_id,
+            "model": model,
+            "answers": summary.ANSWERS,
+            "total_tokens": summary.TOTAL_TOKENS,
+            "avg_top_similarity": summary.AVG_TOP_SIMILARITY,
+            **{k: round(v, 3) for k, v in timings.items()}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a batch of questions with the knowledge base, set-based")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--questions-table", help="table with the questions")
+    source.add_argument("--questions-file", help=".txt, .jsonl or .csv file with the questions")
+    parser.add_argument("--question-column", default="QUESTION")
+    parser.add_argument("--id-column", help="question id column of --questions-table (row number otherwise)")
+    parser.add_argument("--model", default="mistral-7b")
+    parser.add_argument("--num-chunks", type=int, default=3)
+    parser.add_argument("--context-chars", type=int, default=12000, help="knowledge base context per question")
+    parser.add_argument("--chunks-table", default="DOCS_CHUNKS_TABLE")
+    parser.add_argument("--results-table", default="BATCH_ANSWERS")
+    parser.add_argument("--run-id", help="tag for this run in the results table (a uuid otherwise)")
+    parser.add_argument("--connection", help="connection name in connections.toml (the default connection otherwise)")
+    args = parser.parse_args(argv)
+
+    from snowflake.snowpark import Session
+    builder = Session.builder
+    if args.connection:
+        builder = builder.config("connection_name", args.connection)
+    session = builder.create()
+
+    questions = read_questions(args.questions_file) if args.questions_file else None
+    result = run_batch(session, questions=questions, questions_table=args.questions_table,
+                       question_column=args.question_column, id_column=args.id_column,
+                       model=args.model, num_chunks=args.num_chunks,
+                       context_chars=args.context_chars, chunks_table=args.chunks_table,
+                       results_table=args.results_table, run_id=args.run_id)
+    sys.stdout.write(json.dumps(result, indent=2, default=str) + "\n")
+
+
+if __name__ == "__main__":
+    main()
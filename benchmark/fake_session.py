@@ -0,0 +1,333 @@
+#### ------ Fake Snowpark session for offline benchmarks ------ ####
+#
+# Answers the SQL the app issues with canned results after a configurable
+# latency, and records every statement by kind so the benchmark can report
+# round-trips and per-kind latency. Embeddings are hashed bag-of-words vectors,
+# so questions about the same topic retrieve the same chunks.
+
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from completion import CompletionStream
+from vector_index import kmeans
+
+
+EMBED_DIM = 768
+
+# seconds per statement kind, before latency_scale
+DEFAULT_LATENCIES = {
+    "embed": 0.15,
+    "analyze": 0.8,
+    "summary": 1.2,
+    "complete": 2.5,
+    "count_tokens": 0.1,
+    "snowdoc_search": 2.0,
+    "presign": 0.3,
+    "presign_all": 0.4,
+    "index_stats": 0.1,
+    "index_load": 1.0,
+    "vector_search": 0.05,   # plus vector_scan for the share of the chunks scored
+    "vector_scan": 1.0,
+    "answer_cache": 0.2,
+    "precomputed": 0.3,
+    "log_write": 0.5,
+    "trace_write": 0.5,
+    "routing_write": 0.5,
+    "other": 0.1,
+}
+
+# first match wins; statements come with ? binds (see queries.py) or inline values
+SQL_KINDS = [
+    ("embed", r"embed_text_768\('e5-base-v2',\s*[?']"),
+    ("count_tokens", r"cortex\.count_tokens"),
+    ("complete", r"cortex\.complete"),
+    ("snowdoc_search", r"call snowdoc_search"),
+    ("presign_all", r"get_presigned_url\(.*relative_path.*from directory"),
+    ("presign", r"get_presigned_url"),
+    ("index_stats", r"count\(\*\) as n, max\(created_at\)"),
+    ("index_load", r"chunk_vec::array as chunk_vec"),
+    ("vector_search", r"vector_cosine_similarity\(chunk_vec, parse_json"),
+    ("answer_cache", r"answer_cache"),
+    ("precomputed", r"precomputed_answers"),
+    ("log_write", r"chat_history_log"),
+    ("trace_write", r"chat_trace"),
+    ("routing_write", r"model_routing"),
+]
+
+# COMPLETE calls told apart by their prompt, which may be a bind
+PROMPT_KINDS = [
+    ("summary", r"running summary"),
+    ("analyze", r"analyze the user question"),
+]
+
+TOPICS = {
+    "architecture": "Snowflake architecture separates storage compute and cloud services layers virtual warehouses micro-partitions",
+    "hybrid tables": "Hybrid tables support transactional workloads with row storage primary keys indexes available on AWS regions",
+    "cortex": "Cortex LLM functions COMPLETE SUMMARIZE TRANSLATE EXTRACT_ANSWER SENTIMENT EMBED_TEXT models mistral llama reka",
+    "dynamic tables": "Dynamic tables refresh declaratively with target lag compared with streams and tasks pipelines",
+    "anomaly detection": "Cortex ML anomaly detection function trains a model on time series and detects outliers",
+    "streams": "Streams track change data capture on tables and tasks schedule SQL statements",
+    "warehouses": "Virtual warehouses sizes credits auto suspend auto resume multi-cluster scaling policy",
+    "security": "Network policies role based access control masking policies row access policies encryption",
+}
+
+
+def embed_text(text):
+    # hashed bag of words, normalized; deterministic across runs
+    vec = np.zeros(EMBED_DIM, dtype=np.float32)
+    for word in re.findall(r"[a-z0-9_]+", text.lower()):
+        h = int(hashlib.md5(word.encode()).hexdigest(), 16)
+        vec[h % EMBED_DIM] += 1.0 if (h >> 12) & 1 else -1.0
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def make_corpus(num_chunks=300, chunk_chars=2000, seed=0):
+    rng = random.Random(seed)
+    topics = list(TOPICS)
+    corpus = []
+    for i in range(num_chunks):
+        topic = topics[i % len(topics)]
+        words = (TOPICS[topic] + " ").split()
+        text = " ".join(rng.choice(words) for _ in range(chunk_chars // 7))
+        corpus.append({"RELATIVE_PATH": f"{topic.replace(' ', '_')}_guide.pdf", "CHUNK": text})
+    return corpus
+
+
+class FakeRow(dict):
+# Snowpark Row stand-in: row.COL, row["COL"] and row[0] all work
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return dict.__getitem__(self, key)
+
+
+class FakeDataFrame:
+# lazy like a Snowpark DataFrame: the statement runs on the first collect
+
+    def __init__(self, execute):
+        self._execute = execute
+        self._result = None
+
+    @property
+    def _rows(self):
+        if self._result is None:
+            self._result = [FakeRow(r) for r in self._execute()]
+        return self._result
+
+    def collect(self):
+        return self._rows
+
+    def to_pandas(self):
+        return pd.DataFrame(list(map(dict, self._rows)))
+
+    def to_local_iterator(self):
+        return iter(self._rows)
+
+
+class FakeSession:
+
+    def __init__(self, corpus=None, latencies=None, latency_scale=1.0, jitter=0.2,
+                 answer_tokens=250, seed=0):
+        self.corpus = corpus if corpus is not None else make_corpus()
+        self.latencies = dict(DEFAULT_LATENCIES, **(latencies or {}))
+        self.latency_scale = latency_scale
+        self.jitter = jitter
+        self.answer_tokens = answer_tokens
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._loaded_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self._vecs = [embed_text(c["CHUNK"]) for c in self.corpus]
+        self._centroids, self._assign = None, None
+        self.calls = []     # (kind, seconds, thread name)
+
+    #### ------ bookkeeping ------ ####
+
+    def classify(self, query, params=None):
+        q = query.lower()
+        for kind, pattern in SQL_KINDS:
+            if re.search(pattern, q, re.S):
+                break
+        else:
+            return "other"
+        if kind == "complete":
+            prompt = " ".join(str(p) for p in params).lower() if params else q
+            for prompt_kind, pattern in PROMPT_KINDS:
+                if re.search(pattern, prompt, re.S):
+                    return prompt_kind
+        return kind
+
+    def _sleep(self, kind):
+        base = self.latencies.get(kind, self.latencies["other"]) * self.latency_scale
+        with self._lock:
+            factor = 1 + self._rng.uniform(-self.jitter, self.jitter)
+        time.sleep(max(base * factor, 0))
+
+    def reset_calls(self):
+        with self._lock:
+            calls, self.calls = self.calls, []
+        return calls
+
+    #### ------ Snowpark surface ------ ####
+
+    def sql(self, query, params=None):
+        kind = self.classify(query, params)
+
+        def execute():
+            start = time.perf_counter()
+            self._sleep(kind)
+            rows = getattr(self, "_" + kind, self._other)(query, params)
+            with self._lock:
+                self.calls.append((kind, time.perf_counter() - start, threading.current_thread().name))
+            return rows
+
+        return FakeDataFrame(execute)
+
+    #### ------ canned results ------ ####
+
+    def _quoted(self, query, after):
+        match = re.search(after + r"\s*'(.*?)'\s*\)", query, re.S)
+        return match.group(1) if match else ""
+
+    def _embed(self, query, params):
+        text = params[0] if params else self._quoted(query, r"embed_text_768\('e5-base-v2',")
+        return [{"QVEC": json.dumps(embed_text(text).tolist())}]
+
+    def _count_tokens(self, query, params):
+        text = " ".join(str(p) for p in params) if params else query
+        return [{"TOTAL_TOKENS": (len(text) + 3) // 4}]
+
+    def _llm_text(self, query, params=None):
+        text = str(params[-1]) if params else query
+        return " ".join(text.split()[-12:]).strip("'\";)")
+
+    def _analyze(self, query, params):
+        # answers the keys the prompt asks for: the question, shortened, and a topic as keyword
+        prompt = str(params[-1])
+        question = prompt.split("QUESTION:", 1)[-1].strip()
+        answer = {}
+        if '"search_query"' in prompt:
+            answer["search_query"] = question[:128]
+        if '"retrieval_query"' in prompt:
+            answer["retrieval_query"] = " ".join(question.split()[:20])
+        if '"demo_keyword"' in prompt:
+            answer["demo_keyword"] = next((t for t in TOPICS if t in question.lower()), "no")
+        return [{"OUTPUT": None, "RESPONSE": json.dumps(answer),
+                 "TOTAL_TOKENS": (len(prompt) + 3) // 4 + 30}]
+
+    def _summary(self, query, params):
+        prompt = str(params[-1]) if params else query
+        return [{"RESPONSE": "Conversation about " + self._llm_text(query, params),
+                 "TOTAL_TOKENS": (len(prompt) + 3) // 4 + 40}]
+
+    def _complete(self, query, params):
+        prompt_tokens = (len(params[-1] if params else query) + 3) // 4
+        answer = "Snowflake " + " ".join(["answer"] * self.answer_tokens)
+        return [{"OUTPUT": None, "RESPONSE": answer,
+                 "TOTAL_TOKENS": prompt_tokens + self.answer_tokens}]
+
+    def _snowdoc_search(self, query, params):
+        topic = params[0] if params else self._quoted(query, r"snowdoc_search\(")
+        text = " ".join(TOPICS.values()) * 20 + " " + topic
+        urls = "https://docs.snowflake.com/en/user-guide/a, https://docs.snowflake.com/en/sql-reference/b"
+        return [{"SNOWDOC_SEARCH": json.dumps([text, urls])}]
+
+    def _presign_all(self, query, params):
+        paths = sorted({c["RELATIVE_PATH"] for c in self.corpus})
+        return [{"RELATIVE_PATH": p, "PDF_URL": f"https://example.invalid/{p}?sig=1"} for p in paths]
+
+    def _presign(self, query, params):
+        match = re.search(r"get_presigned_url\(\s*@\w+,\s*'(.*?)'", query, re.S | re.I)
+        path = params[0] if params else (match.group(1) if match else "doc.pdf")
+        return [{"PDF_URL": f"https://example.invalid/{path}?sig=1"}]
+
+    def _index_stats(self, query, params):
+        return [{"N": len(self.corpus), "MAX_TS": self._loaded_at}]
+
+    def _index_load(self, query, params):
+        return [{"RELATIVE_PATH": c["RELATIVE_PATH"], "CHUNK": c["CHUNK"],
+                 "CHUNK_VEC": json.dumps(v.tolist()), "CREATED_AT": self._loaded_at}
+                for c, v in zip(self.corpus, self._vecs)]
+
+    def partition(self, lists, seed=0):
+        # what partition_docs(lists, true) leaves in Snowflake: centroids and a cluster id per chunk
+        self._centroids, self._assign = kmeans(np.stack(self._vecs), lists, seed=seed)
+
+    def _vector_search(self, query, params):
+        # vector_search_full (qvec, k) or vector_search_probe (qvec, probes, qvec, k)
+        vecs = np.stack(self._vecs)
+        q = np.asarray(json.loads(params[0]), dtype=np.float32)
+        if "probes as" in query and self._centroids is not None:
+            probes = np.argsort(-(self._centroids @ q))[:int(params[1])]
+            rows = np.flatnonzero(np.isin(self._assign, probes))
+        else:
+            rows = np.arange(len(vecs))
+        time.sleep(self.latencies["vector_scan"] * self.latency_scale * len(rows) / max(len(vecs), 1))
+        scores = vecs[rows] @ q
+        top = rows[np.argsort(-scores)[:int(params[-1])]]
+        return [{"RELATIVE_PATH": self.corpus[i]["RELATIVE_PATH"], "CHUNK": self.corpus[i]["CHUNK"],
+                 "VECTOR": json.dumps(vecs[i].tolist()), "DISTANCE": float(vecs[i] @ q)}
+                for i in top]
+
+    def _answer_cache(self, query, params):
+        return []
+
+    def _precomputed(self, query, params):
+        return []    # no warm-up has run
+
+    def _log_write(self, query, params):
+        return []
+
+    def _trace_write(self, query, params):
+        return []
+
+    def _routing_write(self, query, params):
+        return []
+
+    def _other(self, query, params):
+        return []
+
+
+class FakeCompleter:
+# Streaming completer with a time to first token and a steady token rate,
+# in place of the Cortex streaming API
+
+    def __init__(self, session, ttft_secs=0.6, tokens_per_sec=60):
+        self.session = session
+        self.ttft_secs = ttft_secs
+        self.tokens_per_sec = tokens_per_sec
+
+    def stream(self, model, prompt):
+        scale = self.session.latency_scale
+        start = time.perf_counter()
+        timing = {}
+
+        def chunks():
+            time.sleep(self.ttft_secs * scale)
+            timing["ttft"] = time.perf_counter() - start
+            for i in range(self.session.answer_tokens):
+                yield "Snowflake " if i == 0 else "answer "
+                time.sleep(scale / self.tokens_per_sec)
+            with self.session._lock:
+                self.session.calls.append(("complete", time.perf_counter() - start,
+                                           threading.current_thread().name))
+
+        prompt_tokens = (len(prompt) + 3) // 4
+        stream = CompletionStream(chunks(), lambda text: prompt_tokens + self.session.answer_tokens)
+        stream.timing = timing
+        return stream
@@ -0,0 +1,80 @@
+#### ------ Partitioned against full scan vector search ------ ####
+#
+# Runs the workload questions through the Snowflake side vector search of
+# vector_partitions.py, once as a full scan and once per probe count, and
+# reports, as JSON, recall@k of each probe count against the full scan and
+# the latency of both. Offline on a FakeSession by default, whose scan time
+# grows with the share of the chunks scored; against a real account with
+# --connection, once partition_docs has been called (see setup.sql).
+#
+#   python -m benchmark.partitions --corpus-chunks 20000 --lists 128 --probes 1 2 4 8 16
+#   python -m benchmark.partitions --connection my_conn --probes 4 8 16
+
+import argparse
+import json
+import sys
+import time
+
+from benchmark.fake_session import FakeSession, make_corpus
+from benchmark.run import load_workload, summarize
+from queries import run
+from vector_partitions import search_partitions
+
+
+def questions_of(workload):
+    return [turn for conversation in load_workload(workload) for turn in conversation["turns"]]
+
+
+def timed_search(session, qvec, k, probes):
+    start = time.perf_counter()
+    df = search_partitions(session, qvec, k, probes=probes)
+    return set(zip(df["RELATIVE_PATH"], df["CHUNK"])), time.perf_counter() - start
+
+
+def run_benchmark(session, questions, k=8, probes=(1, 2, 4, 8)):
+    qvecs = [run(session, 'embed_question', q)[0].QVEC for q in questions]
+
+    full, full_secs = [], []
+    for qvec in qvecs:
+        found, secs = timed_search(session, qvec, k, 0)
+        full.append(found)
+        full_secs.append(secs)
+
+    results = {"questions": len(questions), "k": k, "full_scan": {"latency": summarize(full_secs)}}
+    for p in probes:
+        recalls, secs_list = [], []
+        for qvec, expected in zip(qvecs, full):
+            found, secs = timed_search(session, qvec, k, p)
+            recalls.append(len(found & expected) / len(expected) if expected else 1.0)
+            secs_list.append(secs)
+        results[f"probes_{p}"] = {"recall": summarize(recalls), "latency": summarize(secs_list)}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recall and latency of the partitioned vector search")
+    parser.add_argument("--workload", default="benchmark/workload.jsonl")
+    parser.add_argument("--k", type=int, default=8, help="chunks per search, as chunk_candidates in app.py")
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--connection", help="benchmark this Snowflake connection instead of a FakeSession")
+    parser.add_argument("--corpus-chunks", type=int, default=5000, help="fake knowledge base size")
+    parser.add_argument("--lists", type=int, default=64, help="fake partitions, as partition_docs(lists, true)")
+    parser.add_argument("--latency-scale", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.connection:
+        from snowflake.snowpark import Session
+        session = Session.builder.config("connection_name", args.connection).create()
+    else:
+        session = FakeSession(corpus=make_corpus(args.corpus_chunks, seed=args.seed),
+                              latency_scale=args.latency_scale, seed=args.seed)
+        session.partition(args.lists, seed=args.seed)
+
+    results = run_benchmark(session, questions_of(args.workload), args.k, args.probes)
+    results["config"] = vars(args)
+    sys.stdout.write(json.dumps(results, indent=2, default=str) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#### ------ Offline benchmark of the question answering pipeline ------ ####
+#
+# Replays a JSONL workload against app.py with a FakeSession in place of
+# Snowflake and reports, as JSON:
+#   - p50 / p95 / p99 latency end to end, to the first token, per SQL kind
+#     and per traced stage (see tracing.py), prepare / execute time per named statement
+#   - SQL round-trips, tokens and credits (credit_table) per question
+#   - answer cache hit rate
+#
+# Run from the repo root:
+#   python -m benchmark.run --workload benchmark/workload.jsonl --output bench.json
+#   python -m benchmark.run --model auto     # model router against the workload's fixed models
+#
+# Workload lines are either {"question": "..."} or a conversation
+# {"turns": ["...", "..."]}, optionally with "model", "knowledge_base" and
+# "use_chat_history" to override the app defaults for that line.
+
+import argparse
+import json
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import streamlit
+
+import app
+from benchmark.fake_session import FakeCompleter, FakeSession
+from queries import statement_stats
+from tracing import TracedSession, start_trace, trace_span
+
+
+class BenchSessionState(dict):
+# st.session_state stand-in, the app runs without a Streamlit runtime here
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(values):
+    return {"n": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "mean": sum(values) / len(values) if values else None}
+
+
+def load_workload(path):
+    conversations = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            item = json.loads(line)
+            if "question" in item:
+                item["turns"] = [item.pop("question")]
+            conversations.append(item)
+    return conversations
+
+
+def setup(args):
+    session = FakeSession(latency_scale=args.latency_scale, answer_tokens=args.answer_tokens,
+                          seed=args.seed)
+    completer = FakeCompleter(session)
+
+    app.session = TracedSession(session)
+    app.get_completer = lambda: completer
+    streamlit.session_state = BenchSessionState()
+    return session
+
+
+def run_turn(session, question, query_seq, session_id):
+    state = streamlit.session_state
+    start = time.perf_counter()
+    first_token = []
+    trace = start_trace(session_id, query_seq, app.credit_table)
+
+    def on_token(text):
+        if not first_token:
+            first_token.append(time.perf_counter() - start)
+
+    res_text, tot_tokens, reference_url, pdf_relative_path, pdf_url_link, summary_tot_tokens, prompt_tokens = \
+        app.complete(question, on_token=on_token)
+    latency = time.perf_counter() - start
+
+    # the bookkeeping main() does after an answer is shown
+    state.messages.append({"role": "user", "content": question})
+    state.messages.append({"role": "assistant", "content": res_text})
+    route = state.pop("last_route", None)
+    if app.use_chat_history and app.rolling_summary == 1:
+        app.get_memory().update_async(app.session, question, res_text)
+    if app.show_demo_link == 1:
+        app.get_analyzer().keyword(question)
+    with trace_span("log_write"):
+        app.get_log_writer().log_turn(session_id, query_seq, "benchmark", question, res_text)
+    trace.finish()
+    if app.trace_persist == 1:
+        app.get_trace_writer().write_trace(trace)
+
+    return {"question": question,
+            "model": route["model"] if route else app.model_name,
+            "latency": latency,
+            "ttft": first_token[0] if first_token else latency,
+            "tokens": trace.tokens,
+            "credits": trace.credits,
+            "prompt_tokens": prompt_tokens,
+            "stages": [(row["stage"].strip(), row["ms"], row["sql"]) for row in trace.breakdown()]}
+
+
+def run(args):
+    session = setup(args)
+    defaults = {"model_name": app.model_name, "knowledge_base": app.knowledge_base,
+                "use_chat_history": app.use_chat_history}
+
+    if not args.no_warmup:
+        # index load and stage-wide presign happen once per process, not per question
+        app.get_vector_index()
+        app.get_presign_cache()
+    session.reset_calls()
+
+    turns = []
+    for _ in range(args.repeat):
+        for conversation in load_workload(args.workload):
+            app.model_name = args.model or conversation.get("model", defaults["model_name"])
+            app.knowledge_base = int(conversation.get("knowledge_base", defaults["knowledge_base"]))
+            app.use_chat_history = int(conversation.get("use_chat_history", defaults["use_chat_history"]))
+            streamlit.session_state.clear()
+            streamlit.session_state.messages = []
+            session_id = str(uuid.uuid4())
+
+            for query_seq, question in enumerate(conversation["turns"], start=1):
+                turn = run_turn(session, question, query_seq, session_id)
+                calls = session.reset_calls()
+                turn["sql_round_trips"] = len(calls)
+                turn["sql_by_kind"] = defaultdict(list)
+                for kind, seconds, _ in calls:
+                    turn["sql_by_kind"][kind].append(seconds)
+                turns.append(turn)
+
+    app.get_log_writer().flush()
+    app.get_trace_writer().flush()
+    app.get_routing_writer().flush()
+
+    by_kind = defaultdict(list)
+    by_stage, sql_by_stage = defaultdict(list), defaultdict(int)
+    for turn in turns:
+        for kind, seconds in turn.pop("sql_by_kind").items():
+            by_kind[kind].extend(seconds)
+        for stage, ms, sql in turn.pop("stages"):
+            if ms is not None:
+                by_stage[stage].append(ms / 1000)
+            sql_by_stage[stage] += sql
+
+    return {"config": vars(args),
+            "questions": len(turns),
+            "latency": summarize([t["latency"] for t in turns]),
+            "ttft": summarize([t["ttft"] for t in turns]),
+            "sql_latency_by_kind": {kind: summarize(v) for kind, v in sorted(by_kind.items())},
+            "sql_calls_by_kind": {kind: len(v) for kind, v in sorted(by_kind.items())},
+            "stage_latency": {stage: summarize(v) for stage, v in sorted(by_stage.items())},
+            "sql_calls_by_stage": dict(sorted(sql_by_stage.items())),
+            "statements": statement_stats(),
+            "sql_round_trips_per_question": summarize([t["sql_round_trips"] for t in turns]),
+            "tokens_per_question": summarize([t["tokens"] for t in turns]),
+            "credits_per_question": summarize([t["credits"] for t in turns]),
+            "prompt_chunk_tokens_per_answer": summarize([t["prompt_tokens"]["chunks"] for t in turns
+                                                         if t["prompt_tokens"]]),
+            "total_credits": sum(t["credits"] for t in turns),
+            "answers_by_model": dict(Counter(t["model"] for t in turns)),
+            "model_router": app.get_router().stats(),
+            "answer_cache": app.get_answer_cache().stats(),
+            "log_writer": app.get_log_writer().stats(),
+            "trace_writer": app.get_trace_writer().stats(),
+            "query_analysis": app.get_analyzer().stats(),
+            "turns": turns if args.per_turn else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the SnowChat pipeline")
+    parser.add_argument("--workload", default="benchmark/workload.jsonl")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="multiply every fake latency, e.g. 0.1 for a quick run")
+    parser.add_argument("--answer-tokens", type=int, default=250)
+    parser.add_argument("--repeat", type=int, default=1, help="replay the workload this many times")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", help="answer every question with this model, e.g. 'auto', instead of the workload's")
+    parser.add_argument("--no-warmup", action="store_true")
+    parser.add_argument("--per-turn", action="store_true", help="include every turn in the output")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
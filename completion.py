@@ -0,0 +1,86 @@
+#### ------ Completion backends for the final answer ------ ####
+#
+# Every backend has the same shape:
+#
+#     stream = completer.stream(model, prompt)
+#     for token in stream:       # text pieces as they are generated
+#         ...
+#     stream.text, stream.total_tokens   # available once the loop is done
+#
+# so the app can render tokens as they arrive, and a local fake (see the
+# benchmark) can stand in for Cortex.
+
+from queries import run
+
+
+class CompletionError(Exception):
+    # the completion backend failed before or while streaming the answer
+    pass
+
+
+class CompletionStream:
+
+    def __init__(self, chunks, count_tokens):
+        self._chunks = chunks
+        self._count_tokens = count_tokens
+        self._parts = []
+        self.text = None
+        self.total_tokens = None
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if chunk:
+                self._parts.append(chunk)
+                yield chunk
+        self.text = "".join(self._parts)
+        self.total_tokens = self._count_tokens(self.text)
+
+
+def estimate_tokens(text):
+    # rough rule of thumb for English text, used when Cortex can not tell us
+    return (len(text) + 3) // 4
+
+
+class SqlCompleter:
+# Non streaming: one SNOWFLAKE.CORTEX.COMPLETE query, the whole answer arrives as one piece
+
+    def __init__(self, session):
+        self.session = session
+
+    def stream(self, model, prompt):
+        usage = {}
+
+        def chunks():
+            response = run(self.session, "chat_complete", model, prompt)
+            usage["total_tokens"] = response[0].TOTAL_TOKENS
+            yield response[0].RESPONSE
+
+        return CompletionStream(chunks(), lambda text: usage.get("total_tokens"))
+
+
+class CortexCompleter:
+# Streaming through the Cortex Python API (snowflake-ml-python). The stream carries
+# no usage, so tokens are counted with COUNT_TOKENS once the answer is complete,
+# after the user has already seen it
+
+    def __init__(self, session):
+        from snowflake.cortex import Complete
+        self._complete = Complete
+        self.session = session
+
+    def count_tokens(self, model, prompt, text):
+        try:
+            return run(self.session, "count_tokens", model, prompt, model, text)[0].TOTAL_TOKENS
+        except Exception:
+            return estimate_tokens(prompt) + estimate_tokens(text)
+
+    def stream(self, model, prompt):
+        # REST and parse errors of the stream are not SnowparkSQLException, they
+        # surface as CompletionError whether they happen on the call or mid answer
+        def chunks():
+            try:
+                yield from self._complete(model, prompt, session=self.session, stream=True)
+            except Exception as e:
+                raise CompletionError(f"{model} did not complete the answer: {e}") from e
+
+        return CompletionStream(chunks(), lambda text: self.count_tokens(model, prompt, text))
@@ -0,0 +1,92 @@
+#### ------ Knowledge base context pruning ------ ####
+#
+# The vector search returns a fixed number of candidates however similar they
+# are, and consecutive chunks of a pdf share chunk_overlap characters. Before
+# the prompt, the candidates are:
+#
+#   1. cut     below min_similarity, or further than relative_margin below the
+#              best candidate, which makes k adaptive: a question with one
+#              clear match gets one chunk, a broad one up to max_k
+#   2. picked  by maximal marginal relevance, trading similarity to the question
+#              (mmr_lambda) against similarity to the chunks already picked, so
+#              near-duplicates (above duplicate_similarity) never make it twice
+#   3. merged  when two picked chunks of the same RELATIVE_PATH overlap, into
+#              one chunk without the repeated text
+#
+# The best candidate is always kept, the context is never emptier than before.
+
+import numpy as np
+import pandas as pd
+
+from vector_index import normalize
+
+
+MIN_OVERLAP = 40      # characters of a chunk's head that must be found in the other's tail
+MAX_OVERLAP = 600     # how far back in the other chunk's tail to look for them
+
+
+def merge_overlap(first, second, min_overlap=MIN_OVERLAP, max_overlap=MAX_OVERLAP):
+    # first + second without the text they share, when second starts with the end
+    # of first; None when they don't overlap
+    if len(second) < min_overlap:
+        return None
+    tail_start = max(0, len(first) - max_overlap)
+    pos = first.find(second[:min_overlap], tail_start)
+    while pos != -1:
+        if second.startswith(first[pos:]):
+            return first[:pos] + second
+        pos = first.find(second[:min_overlap], pos + 1)
+    return None
+
+
+def mmr_select(scores, vecs, max_k, mmr_lambda=0.7, duplicate_similarity=0.97):
+    # indices picked by maximal marginal relevance, best first
+    picked = [int(np.argmax(scores))]
+    remaining = [i for i in range(len(scores)) if i != picked[0]]
+    while remaining and len(picked) < max_k:
+        redundancy = (vecs[remaining] @ vecs[picked].T).max(axis=1)
+        mmr = mmr_lambda * scores[remaining] - (1 - mmr_lambda) * redundancy
+        best = int(np.argmax(mmr))
+        if redundancy[best] < duplicate_similarity:
+            picked.append(remaining[best])
+        remaining.pop(best)
+    return picked
+
+
+def merge_chunks(rows):
+    # rows of (chunk, path, score), best first; overlapping chunks of the same path
+    # are folded into the first one, which keeps its score
+    merged = []
+    for chunk, path, score in rows:
+        for i, (kept, kept_path, kept_score) in enumerate(merged):
+            if kept_path != path:
+                continue
+            text = merge_overlap(kept, chunk) or merge_overlap(chunk, kept)
+            if text is not None:
+                merged[i] = (text, kept_path, kept_score)
+                break
+        else:
+            merged.append((chunk, path, score))
+    return merged
+
+
+def prune_chunks(df_chunks, max_k, min_similarity=0.75, relative_margin=0.08,
+                 mmr_lambda=0.7, duplicate_similarity=0.97):
+    # df_chunks as returned by VectorIndex.search(..., with_vectors=True);
+    # returns CHUNK, RELATIVE_PATH and DISTANCE of the chunks to keep, best first
+    columns = ["CHUNK", "RELATIVE_PATH", "DISTANCE"]
+    if len(df_chunks) == 0 or max_k <= 0:
+        return pd.DataFrame(columns=columns)
+
+    scores = df_chunks["DISTANCE"].to_numpy(dtype=np.float32)
+    cutoff = max(min_similarity, float(scores.max()) - relative_margin)
+    keep = np.flatnonzero(scores >= cutoff)
+    if len(keep) == 0:
+        keep = np.array([int(np.argmax(scores))])
+
+    vecs = normalize(np.vstack(df_chunks["VECTOR"].to_numpy()[keep]))
+    picked = keep[mmr_select(scores[keep], vecs, max_k, mmr_lambda, duplicate_similarity)]
+
+    rows = merge_chunks([(df_chunks["CHUNK"].iat[i], df_chunks["RELATIVE_PATH"].iat[i], float(scores[i]))
+                         for i in picked])
+    return pd.DataFrame(rows, columns=columns)
@@ -0,0 +1,74 @@
+#### ------ Rolling conversation summary ------ ####
+#
+# Instead of asking the chat model to summarize the whole history window before
+# every follow-up, the summary is kept per conversation (in st.session_state)
+# and updated from the newest question and answer only, by a small fixed model,
+# in the background right after the answer is shown. A follow-up question is
+# then retrieved with the summary at hand, without an LLM round-trip first.
+
+import threading
+
+from completion import SqlCompleter
+from stages import get_background_pool
+
+
+class ConversationMemory:
+
+    def __init__(self, model='mistral-7b', max_words=60, answer_chars=1500):
+        self.model = model
+        self.max_words = max_words
+        self.answer_chars = answer_chars     # only the start of a long answer is summarized
+
+        self.summary = ""
+        self.turns = 0
+        self._unbilled_tokens = 0
+        self._future = None
+        self._lock = threading.Lock()
+
+    def _prompt(self, question, answer):
+        prompt = f"""
+            Update the running summary of a conversation about Snowflake with the newest exchange.
+            Keep product, feature and object names. Stay high level.
+            The summary must be in natural language and less than {self.max_words} words.
+            Only output the updated summary.
+
+            SUMMARY SO FAR: {self.summary or '(none)'}
+            NEW QUESTION: {question}
+            NEW ANSWER: {answer[:self.answer_chars]}
+            """
+        return prompt
+
+    def update(self, session, question, answer):
+        stream = SqlCompleter(session).stream(self.model, self._prompt(question, answer))
+        summary = "".join(stream).strip()
+        with self._lock:
+            self.summary = summary
+            self.turns += 1
+            self._unbilled_tokens += stream.total_tokens or 0
+        return summary
+
+    def update_async(self, session, question, answer):
+        self._future = get_background_pool().submit(self.update, session, question, answer)
+        return self._future
+
+    def current_summary(self, wait_secs=2.0):
+        # give a running update a moment to land, otherwise use the previous summary
+        future = self._future
+        if future is not None and not future.done():
+            try:
+                future.result(timeout=wait_secs)
+            except Exception:
+                pass
+        return self.summary
+
+    def retrieval_query(self, question, wait_secs=2.0):
+        summary = self.current_summary(wait_secs)
+        if not summary:
+            return question
+        return f"{question} (conversation so far: {summary})"
+
+    def take_tokens(self):
+        # tokens spent on summary updates since the last call, for credit accounting
+        with self._lock:
+            tokens, self._unbilled_tokens = self._unbilled_tokens, 0
+        return tokens
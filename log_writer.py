@@ -0,0 +1,177 @@
+#### ------ Background writer for CHAT_HISTORY_LOG ------ ####
+#
+# Chat turns and feedback submits are queued in process, stamped with a client
+# side timestamp, and written by a background thread in one MERGE per batch,
+# when max_batch rows are waiting or flush_secs have passed, and once more when
+# the process exits. A chat turn no longer pays for a timestamp query and a
+# write_pandas (temp stage + PUT + COPY) on the critical path.
+#
+# BatchWriter is the queue / thread / flush part; subclasses say how rows are
+# keyed and written (ChatLogWriter here, TraceWriter in tracing.py).
+
+import atexit
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+
+from queries import run
+
+
+logger = logging.getLogger(__name__)
+
+LOG_COLUMNS = ["TIMESTAMP", "SESSION_ID", "QUERY_SEQ", "USER_NAME",
+               "QUERY", "RESPONSE", "FEEDBACK", "SUGGESTION"]
+
+
+def client_timestamp():
+    # same shape as CURRENT_TIMESTAMP(0)::varchar
+    return datetime.datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S.000 %z")
+
+
+class BatchWriter:
+
+    thread_name = "batch-writer"
+
+    def __init__(self, session, table, max_batch=50, flush_secs=5, max_retries=3):
+        self.session = session
+        self.table = table
+        self.max_batch = max_batch
+        self.flush_secs = flush_secs
+        self.max_retries = max_retries
+
+        self._queue = queue.Queue()
+        self._pending = {}     # _key(row) -> row, not written yet
+        self._retries = 0
+        self._flush_requested = threading.Event()
+        self._flushed = threading.Condition()
+        self._stop = threading.Event()
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_secs = 0.0
+        self.total_flush_secs = 0.0
+
+        self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    #### ------ producers ------ ####
+
+    def _put(self, item):
+        self._queue.put(item)
+        if self._queue.qsize() >= self.max_batch:
+            self._flush_requested.set()
+
+    #### ------ metrics ------ ####
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() + len(self._pending)
+
+    def stats(self):
+        return {"queue_depth": self.queue_depth,
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "last_flush_secs": round(self.last_flush_secs, 3),
+                "avg_flush_secs": round(self.total_flush_secs / self.flushes, 3) if self.flushes else 0.0}
+
+    #### ------ writer thread ------ ####
+
+    def _key(self, item):
+        raise NotImplementedError
+
+    def _write(self, rows):
+        raise NotImplementedError
+
+    def _drain(self):
+        # items with the same key are folded into one row, so each key appears
+        # once in a MERGE source
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._pending.setdefault(self._key(item), {}).update(item)
+
+    def _flush(self):
+        self._drain()
+        if not self._pending:
+            return
+        rows = list(self._pending.values())
+        start = time.perf_counter()
+        try:
+            self._write(rows)
+        except Exception:
+            self._retries += 1
+            if self._retries < self.max_retries:
+                logger.warning("%s flush failed, retrying later", self.table, exc_info=True)
+                return
+            logger.exception("Dropping %d %s rows after %d failed flushes", len(rows), self.table, self._retries)
+        else:
+            self.rows_written += len(rows)
+        self._retries = 0
+        self._pending.clear()
+        self.last_flush_secs = time.perf_counter() - start
+        self.total_flush_secs += self.last_flush_secs
+        self.flushes += 1
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self._stop.is_set():
+            self._flush_requested.wait(timeout=min(1.0, self.flush_secs))
+            due = (self._flush_requested.is_set()
+                   or self.queue_depth >= self.max_batch
+                   or time.monotonic() - last_flush >= self.flush_secs)
+            if due:
+                self._flush_requested.clear()
+                self._flush()
+                last_flush = time.monotonic()
+                with self._flushed:
+                    self._flushed.notify_all()
+        self._flush()
+
+    #### ------ control ------ ####
+
+    def flush(self, timeout=30):
+        # ask the writer thread to flush now and wait for it
+        with self._flushed:
+            self._flush_requested.set()
+            self._flushed.wait(timeout)
+
+    def close(self, timeout=30):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._flush_requested.set()
+        self._thread.join(timeout)
+
+
+class ChatLogWriter(BatchWriter):
+
+    thread_name = "chat-log-writer"
+
+    def __init__(self, session, table="CHAT_HISTORY_LOG", max_batch=50,
+                 flush_secs=5, max_retries=3):
+        super().__init__(session, table, max_batch, flush_secs, max_retries)
+
+    def log_turn(self, session_id, query_seq, user_name, query, response,
+                 feedback=None, suggestion=None):
+        self._put({"TIMESTAMP": client_timestamp(), "SESSION_ID": session_id,
+                   "QUERY_SEQ": query_seq, "USER_NAME": user_name,
+                   "QUERY": query, "RESPONSE": response,
+                   "FEEDBACK": feedback, "SUGGESTION": suggestion})
+
+    def log_feedback(self, session_id, query_seq, feedback, suggestion):
+        self._put({"SESSION_ID": session_id, "QUERY_SEQ": query_seq,
+                   "FEEDBACK": feedback, "SUGGESTION": suggestion})
+
+    def _key(self, item):
+        # feedback for a turn that is still pending is folded into its row
+        return (item["SESSION_ID"], item["QUERY_SEQ"])
+
+    def _write(self, rows):
+        source = json.dumps([[row.get(col) for col in LOG_COLUMNS] for row in rows])
+        run(self.session, "chat_log_merge", source, table=self.table)
@@ -0,0 +1,160 @@
+#### ------ Model router for the "auto" model ------ ####
+#
+# Picks the answer model per question instead of sending everything to the
+# model selected in the app:
+#
+#   complexity   0..1 from the question alone (length, several questions in one,
+#                comparisons, design / troubleshooting / code requests), no LLM call
+#   confidence   similarity of the best knowledge base chunk kept for the prompt;
+#                a question with little grounding needs a model that knows more
+#
+# Both give the quality level needed (1: simple lookup ... 4: hardest), and the
+# router picks the cheapest model in the credit table with at least that
+# quality whose typical answer time is within max_answer_secs. When the answer
+# still comes back as "I don't have the information" while the context was
+# good, it is asked again once to the next model up (escalation).
+#
+# Every answer, auto or fixed model, is logged to MODEL_ROUTING with the
+# decision, the completion time, tokens and credits, so the savings can be
+# compared with fixed model runs (see setup.sql).
+
+import json
+import re
+import threading
+from collections import Counter
+
+from log_writer import BatchWriter, client_timestamp
+from queries import run
+
+
+ROUTING_COLUMNS = ["TIMESTAMP", "SESSION_ID", "QUERY_SEQ", "MODE", "MODEL", "ESCALATED_FROM",
+                   "COMPLEXITY", "CONFIDENCE", "QUALITY", "REASON", "COMPLETE_MS", "TOKENS", "CREDITS"]
+
+COMPLEX_PATTERNS = [
+    r"\b(compare|comparison|differences?|versus|vs\.?|trade-?offs?|pros and cons)\b",
+    r"\b(design|architect\w*|migrat\w*|optimi[sz]\w*|troubleshoot\w*|best practices?)\b",
+    r"\b(why|explain how|step by step|walk me through)\b",
+    r"\b(example|write|generate|code|sql|python|script)\b",
+]
+
+DECLINED = re.compile(r"(do not|don't|don´t) have (the|enough|any|this) information"
+                      r"|not (mentioned|provided|included) in the|i'?m not sure|i cannot answer", re.I)
+
+
+def question_complexity(question):
+    words = len(question.split())
+    score = min(words / 60, 0.4)
+    score += 0.15 * sum(1 for pattern in COMPLEX_PATTERNS if re.search(pattern, question, re.I))
+    if question.count("?") > 1:
+        score += 0.15
+    return round(min(score, 1.0), 2)
+
+
+def declined(answer):
+    # the model said it could not answer, or barely answered
+    return not answer or len(answer.strip()) < 20 or bool(DECLINED.search(answer))
+
+
+class ModelRouter:
+
+    def __init__(self, credit_table, quality, answer_secs, min_quality=1, max_answer_secs=10,
+                 min_confidence=0.8, max_escalations=1):
+        # quality: model -> level 1..4, answer_secs: model -> typical seconds for an answer;
+        # only models in all three tables are routed to
+        self.credit_table = credit_table
+        self.quality = quality
+        self.answer_secs = answer_secs
+        self.min_quality = min_quality
+        self.max_answer_secs = max_answer_secs
+        self.min_confidence = min_confidence
+        self.max_escalations = max_escalations
+
+        self._lock = threading.Lock()
+        self.routed = Counter()
+        self.escalations = 0
+
+    def _models(self):
+        # cheapest first
+        return sorted((m for m in self.quality if m in self.credit_table and m in self.answer_secs),
+                      key=lambda m: (self.credit_table[m], self.answer_secs[m]))
+
+    def _pick(self, level):
+        # cheapest model with the quality within the latency target, the cheapest with the
+        # quality otherwise, the best one when none has it
+        models = self._models()
+        able = [m for m in models if self.quality[m] >= level]
+        if not able:
+            return max(models, key=lambda m: self.quality[m]), "best available"
+        fast = [m for m in able if self.answer_secs[m] <= self.max_answer_secs]
+        if fast:
+            return fast[0], "cheapest within target"
+        return able[0], "cheapest, over latency target"
+
+    def fixed(self, model):
+        return {"mode": "fixed", "model": model, "escalated_from": None, "complexity": None,
+                "confidence": None, "quality": self.quality.get(model), "reason": "selected",
+                "escalations": 0, "tokens": 0, "credits": 0.0, "complete_ms": 0.0}
+
+    def route(self, question, confidence=None, doc_pages=False):
+        # confidence: best chunk similarity, None without knowledge base;
+        # doc_pages: the live doc search found pages
+        complexity = question_complexity(question)
+        level = max(self.min_quality, 1 + round(complexity * 2))
+        grounded = doc_pages or (confidence is not None and confidence >= self.min_confidence)
+        if not grounded:
+            level += 1
+        model, reason = self._pick(level)
+        with self._lock:
+            self.routed[model] += 1
+        return {"mode": "auto", "model": model, "escalated_from": None, "complexity": complexity,
+                "confidence": None if confidence is None else round(float(confidence), 3),
+                "quality": level, "reason": reason + ("" if grounded else ", low retrieval confidence"),
+                "escalations": 0, "tokens": 0, "credits": 0.0, "complete_ms": 0.0}
+
+    def escalate(self, decision, answer, context_found=True):
+        # next model up when an auto answer declined although there was context, else None
+        if (decision["mode"] != "auto" or decision["escalations"] >= self.max_escalations
+                or not context_found or not declined(answer)):
+            return None
+        current = self.quality.get(decision["model"], 0)
+        if not any(q > current for q in self.quality.values()):
+            return None
+        model, _ = self._pick(current + 1)
+        with self._lock:
+            self.escalations += 1
+            self.routed[model] += 1
+        decision.update({"escalated_from": decision["model"], "model": model,
+                         "escalations": decision["escalations"] + 1,
+                         "reason": "escalated, answer declined"})
+        return model
+
+    def charge(self, decision, tokens, model, secs):
+        # tokens, credits and completion time of every answer attempt
+        tokens = tokens or 0
+        decision["tokens"] += tokens
+        decision["credits"] += tokens * self.credit_table.get(model, 0) / 1000000
+        decision["complete_ms"] += secs * 1000
+
+    def stats(self):
+        with self._lock:
+            return {"routed": dict(self.routed), "escalations": self.escalations}
+
+
+class RoutingLogWriter(BatchWriter):
+
+    thread_name = "model-routing-writer"
+
+    def __init__(self, session, table="MODEL_ROUTING", max_batch=50,
+                 flush_secs=5, max_retries=3):
+        super().__init__(session, table, max_batch, flush_secs, max_retries)
+
+    def log_decision(self, session_id, query_seq, decision):
+        self._put({"TIMESTAMP": client_timestamp(), "SESSION_ID": session_id, "QUERY_SEQ": query_seq,
+                   **{col: decision.get(col.lower()) for col in ROUTING_COLUMNS[3:]}})
+
+    def _key(self, item):
+        return (item["SESSION_ID"], item["QUERY_SEQ"])
+
+    def _write(self, rows):
+        source = json.dumps([[row.get(col) for col in ROUTING_COLUMNS] for row in rows])
+        run(self.session, "routing_insert", source, table=self.table)
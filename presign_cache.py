@@ -0,0 +1,68 @@
+#### ------ Presigned URL cache for the PDFs in @docs ------ ####
+#
+# URLs are kept per RELATIVE_PATH with the time they expire. A URL is handed out
+# only while it still has refresh_margin_secs to live (so the user has time to
+# click it), the whole stage is re-signed in the background in one query when
+# the cached URLs get close to that point, and a path that is missing or
+# expired is signed on its own without scanning directory(@docs).
+
+import threading
+import time
+
+from queries import run
+from stages import get_background_pool
+
+
+class PresignedUrlCache:
+
+    def __init__(self, session, stage='@docs', expiry_secs=360, refresh_margin_secs=60):
+        self.session = session
+        self.stage = stage
+        self.expiry_secs = expiry_secs
+        self.refresh_margin_secs = refresh_margin_secs
+
+        self._lock = threading.Lock()
+        self._urls = {}      # relative_path -> (url, expires_at)
+        self._refreshing = False
+
+    def warm(self):
+        # sign every file of the stage in one query
+        signed_at = time.time()
+        rows = run(self.session, "presign_stage", self.expiry_secs, stage=self.stage)
+        with self._lock:
+            for row in rows:
+                self._urls[row.RELATIVE_PATH] = (row.PDF_URL, signed_at + self.expiry_secs)
+        return len(rows)
+
+    def _sign(self, relative_path):
+        signed_at = time.time()
+        url = run(self.session, "presign_path", relative_path, self.expiry_secs,
+                  stage=self.stage)[0].PDF_URL
+        with self._lock:
+            self._urls[relative_path] = (url, signed_at + self.expiry_secs)
+        return url
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self.warm()
+            finally:
+                self._refreshing = False
+
+        get_background_pool().submit(refresh)
+
+    def get(self, relative_path):
+        with self._lock:
+            url, expires_at = self._urls.get(relative_path, (None, 0))
+        remaining = expires_at - time.time()
+
+        if remaining < self.refresh_margin_secs:
+            return self._sign(relative_path)
+        if remaining < 2 * self.refresh_margin_secs:
+            self._refresh_in_background()
+        return url
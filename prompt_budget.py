@@ -0,0 +1,149 @@
+#### ------ Token budget for the final prompt ------ ####
+#
+# Fits chat history, knowledge base chunks and scraped doc pages into a token
+# budget (the model's context window minus room for the answer, capped by a
+# configurable budget). When there is too much, the scraped page text goes
+# first, keeping its passages that best match the question, then the lowest
+# ranked chunks, and the chat history is trimmed last, oldest turn first.
+
+import math
+import re
+
+from completion import estimate_tokens
+
+
+# context window in tokens per model
+MODEL_CONTEXT_WINDOWS = {
+    'mistral-7b': 32000,
+    'mixtral-8x7b': 32000,
+    'reka-flash': 100000,
+    'mistral-large': 32000,
+    'llama3.1-70b': 128000,
+    'llama3.1-405b': 128000,
+    'llama3-8b': 8000,
+    'llama3-70b': 8000,
+}
+DEFAULT_CONTEXT_WINDOW = 8000
+
+# instructions ahead of the chat history, context and question; shared by the app and batch_qa.py
+PROMPT_INSTRUCTIONS = """
+          You are an Snowflake expert chat assistance that extracts information from the CONTEXT provided.
+           You offer a chat experience considering the information included in the CHAT HISTORY.
+           When ansering the question be concise, structured and do not hallucinate. 
+           If you don´t have the information just say so.
+           
+           Do not mention the CONTEXT used in your answer.
+           Do not mention the CHAT HISTORY used in your asnwer.
+           """
+
+PASSAGE_CHARS = 800      # scraped pages are ranked in passages of about this size
+MIN_PIECE_TOKENS = 64    # don't bother adding a truncated piece smaller than this
+
+STOPWORDS = {"the", "and", "for", "with", "what", "how", "does", "can", "you", "are",
+             "is", "in", "of", "to", "a", "an", "on", "or", "be", "do", "i", "it",
+             "my", "me", "about", "this", "that", "from", "use", "using", "give", "example"}
+
+
+def terms(text):
+    return [w for w in re.findall(r"[a-z0-9_$]+", text.lower()) if w not in STOPWORDS and len(w) > 1]
+
+
+def split_passages(text, size=PASSAGE_CHARS):
+    # roughly size characters per passage, cut after a sentence when possible
+    passages, start = [], 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            stop = text.rfind(". ", start + size // 2, end)
+            end = stop + 1 if stop >= 0 else end
+        passage = text[start:end].strip()
+        if passage:
+            passages.append(passage)
+        start = end
+    return passages
+
+
+def rank_passages(passages, question):
+    # term overlap with the question, with a slight preference for the top of the page
+    query = set(terms(question))
+    scored = []
+    for position, passage in enumerate(passages):
+        counts = {}
+        for term in terms(passage):
+            if term in query:
+                counts[term] = counts.get(term, 0) + 1
+        score = sum(1 + math.log(c) for c in counts.values()) - 0.01 * position
+        scored.append((score, position, passage))
+    scored.sort(key=lambda s: (-s[0], s[1]))
+    return scored
+
+
+def truncate_to_tokens(text, tokens):
+    return text[:max(tokens, 0) * 4]
+
+
+class PromptBudgeter:
+
+    def __init__(self, model, max_prompt_tokens=None, answer_tokens=1024):
+        window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+        self.budget = window - answer_tokens
+        if max_prompt_tokens:
+            self.budget = min(self.budget, max_prompt_tokens)
+
+    def fit(self, instructions, question, history_turns, chunks, page_text):
+        # returns (chat_history, context, report); report has the tokens used per section
+        fixed = estimate_tokens(instructions) + estimate_tokens(question)
+        available = max(self.budget - fixed, 0)
+
+        # history is trimmed last: it keeps what it needs unless that would leave the
+        # retrieved context less than half of what is available
+        history_turns = list(history_turns)
+        history_tokens = sum(estimate_tokens(t) for t in history_turns)
+        while history_turns and history_tokens > available // 2 and history_tokens + self._context_need(chunks, page_text) > available:
+            history_tokens -= estimate_tokens(history_turns.pop(0))
+        remaining = available - history_tokens
+
+        # chunks in their retrieval order
+        kept_chunks, chunk_tokens = [], 0
+        for chunk in chunks:
+            tokens = estimate_tokens(chunk)
+            if tokens > remaining:
+                if remaining >= MIN_PIECE_TOKENS:
+                    chunk = truncate_to_tokens(chunk, remaining)
+                    kept_chunks.append(chunk)
+                    chunk_tokens += estimate_tokens(chunk)
+                    remaining -= estimate_tokens(chunk)
+                break
+            kept_chunks.append(chunk)
+            chunk_tokens += tokens
+            remaining -= tokens
+
+        # best matching passages of the scraped pages, put back in page order
+        kept_passages, page_tokens = [], 0
+        if page_text:
+            for score, position, passage in rank_passages(split_passages(page_text), question):
+                tokens = estimate_tokens(passage)
+                if tokens > remaining:
+                    if remaining < MIN_PIECE_TOKENS:
+                        break
+                    passage = truncate_to_tokens(passage, remaining)
+                    tokens = estimate_tokens(passage)
+                kept_passages.append((position, passage))
+                page_tokens += tokens
+                remaining -= tokens
+            kept_passages.sort()
+
+        chat_history = "".join(history_turns)
+        context = "".join(kept_chunks) + " ".join(p for _, p in kept_passages)
+
+        report = {"instructions": estimate_tokens(instructions),
+                  "question": estimate_tokens(question),
+                  "history": history_tokens,
+                  "chunks": chunk_tokens,
+                  "doc_pages": page_tokens,
+                  "total": fixed + history_tokens + chunk_tokens + page_tokens,
+                  "budget": self.budget}
+        return chat_history, context, report
+
+    def _context_need(self, chunks, page_text):
+        return sum(estimate_tokens(c) for c in chunks) + estimate_tokens(page_text or "")
@@ -0,0 +1,343 @@
+#### ------ Named SQL statements with bind parameters ------ ####
+#
+# Every statement the app runs with a value in it (question, prompt, model,
+# path, vector, log rows, ...) is declared here once, by name, with ?
+# placeholders, and run with run(session, name, *params). Snowflake then sees
+# the same text for every question: the plan of a statement is reused,
+# deterministic lookups can be answered from the result cache, and values
+# travel as binds, so they no longer need their quotes stripped. The page cache
+# of snowdoc_scraper.py is the one exception, it runs inside the snowdoc_search
+# procedure, which stages that file alone.
+#
+# Only identifiers (table and stage names from the app config) are put in the
+# text, as {table} / {stage}. Each run records the client side prepare and
+# execute time of its statement; server_stats() reads the compile / execution
+# split Snowflake reports for them from query history.
+
+import json
+import threading
+import time
+
+
+STATEMENTS = {
+
+    #### ------ question pipeline ------ ####
+
+    "embed_question": """
+        select snowflake.cortex.embed_text_768('e5-base-v2', ?)::array as qvec""",
+
+    "analyze_question": """
+        select snowflake.cortex.complete(?, [{'role': 'user', 'content': ?}], {'temperature': 0}) as output,
+               trim(get(output:choices,0):messages,'" ') as response,
+               output:usage:total_tokens::int as total_tokens""",
+
+    "snowdoc_search": """
+        call snowdoc_search(?)""",
+
+    "chat_complete": """
+        select snowflake.cortex.complete(?, [{'role': 'user', 'content': ?}], {}) as output,
+               trim(get(output:choices,0):messages,'" ') as response,
+               output:usage:total_tokens::int as total_tokens""",
+
+    "count_tokens": """
+        select snowflake.cortex.count_tokens(?, ?)
+             + snowflake.cortex.count_tokens(?, ?) as total_tokens""",
+
+    #### ------ presigned urls ------ ####
+
+    "presign_stage": """
+        select relative_path, get_presigned_url({stage}, relative_path, ?) as pdf_url
+        from directory({stage})""",
+
+    "presign_path": """
+        select get_presigned_url({stage}, ?, ?) as pdf_url""",
+
+    #### ------ vector index ------ ####
+
+    "index_stats": """
+        select count(*) as n, max(created_at) as max_ts from {table}""",
+
+    "index_load": """
+        select relative_path, chunk, chunk_vec::array as chunk_vec, created_at
+        from {table}""",
+
+    "index_load_since": """
+        select relative_path, chunk, chunk_vec::array as chunk_vec, created_at
+        from {table}
+        where created_at > ?::timestamp_ltz""",
+
+    #### ------ vector search in Snowflake (vector_partitions.py) ------ ####
+
+    "vector_search_full": """
+        select relative_path, chunk, chunk_vec::array as vector,
+               vector_cosine_similarity(chunk_vec, parse_json(?)::array::vector(float, 768)) as distance
+        from {table}
+        qualify row_number() over (order by distance desc) <= ?""",
+
+    # nearest partitions first, then only their chunks (and the ones not assigned yet)
+    "vector_search_probe": """
+        with probes as (
+            select cluster_id
+            from {centroids}
+            qualify row_number() over (
+                order by vector_cosine_similarity(centroid, parse_json(?)::array::vector(float, 768)) desc) <= ?
+        )
+        select relative_path, chunk, chunk_vec::array as vector,
+               vector_cosine_similarity(chunk_vec, parse_json(?)::array::vector(float, 768)) as distance
+        from {table}
+        where cluster_id in (select cluster_id from probes) or cluster_id is null
+        qualify row_number() over (order by distance desc) <= ?""",
+
+    "partition_stats": """
+        select (select count(*) from {table}) as chunks,
+               count(*) as lists, max(trained_size) as trained_size
+        from {centroids}""",
+
+    "partition_sample": """
+        select chunk_vec::array as chunk_vec
+        from {table}
+        qualify row_number() over (order by random()) <= ?""",
+
+    "partition_centroids_replace": """
+        insert overwrite into {centroids} (cluster_id, centroid, trained_size)
+        select value[0]::int, value[1]::array::vector(float, 768), ?
+        from table(flatten(parse_json(?)))""",
+
+    # every chunk (true) or the ones not assigned yet (false) to their nearest centroid
+    "partition_assign": """
+        update {table} d set cluster_id = a.cluster_id
+        from (
+            select c.relative_path, c.chunk_hash, p.cluster_id
+            from {table} c
+            cross join {centroids} p
+            where c.cluster_id is null or ?
+            qualify row_number() over (partition by c.relative_path, c.chunk_hash
+                                       order by vector_cosine_similarity(c.chunk_vec, p.centroid) desc) = 1
+        ) a
+        where d.relative_path = a.relative_path and d.chunk_hash = a.chunk_hash""",
+
+    #### ------ answer cache ------ ####
+
+    "answer_cache_lookup": """
+        select question, qvec::array as qvec, payload, similarity
+        from (select question, qvec, payload,
+                     vector_cosine_similarity(qvec, parse_json(?)::array::vector(float, 768)) as similarity
+              from {table}
+              where scope = ?
+                and created_at > dateadd(second, -?, current_timestamp()))
+        where similarity >= ?
+        order by similarity desc
+        limit 1""",
+
+    "answer_cache_insert": """
+        insert into {table} (scope, question, qvec, payload)
+        select ?, ?, parse_json(?)::array::vector(float, 768), parse_json(?)""",
+
+    #### ------ batch question answering (batch_qa.py) ------ ####
+
+    # questions are embedded as they are loaded, one statement for the whole batch
+    "batch_load_table": """
+        create or replace temporary table batch_questions as
+        select {id_column}::varchar as question_id, {question_column}::varchar as question,
+               snowflake.cortex.embed_text_768('e5-base-v2', {question_column}) as qvec
+        from {source}
+        where {question_column} is not null""",
+
+    "batch_load_rows": """
+        create or replace temporary table batch_questions as
+        select value[0]::varchar as question_id, value[1]::varchar as question,
+               snowflake.cortex.embed_text_768('e5-base-v2', value[1]::varchar) as qvec
+        from table(flatten(parse_json(?)))""",
+
+    # top-k chunks per question in one similarity join
+    "batch_retrieve": """
+        create or replace temporary table batch_context as
+        select q.question_id, c.relative_path, c.chunk,
+               vector_cosine_similarity(c.chunk_vec, q.qvec) as similarity
+        from batch_questions q
+        cross join {chunks_table} c
+        qualify row_number() over (partition by q.question_id order by similarity desc) <= ?""",
+
+    # one COMPLETE per question, all in a single INSERT ... SELECT
+    "batch_complete": """
+        insert into {table} (run_id, question_id, question, model, response, sources,
+                             top_similarity, prompt_tokens, completion_tokens, total_tokens)
+        with context as (
+            select question_id,
+                   left(listagg(chunk, ' ') within group (order by similarity desc), ?) as context,
+                   array_agg(distinct relative_path) as sources,
+                   max(similarity) as top_similarity
+            from batch_context
+            group by question_id
+        ),
+        answered as (
+            select q.question_id, q.question, c.sources, c.top_similarity,
+                   snowflake.cortex.complete(?, [{'role': 'user',
+                                                  'content': ? || '\n CONTEXT: ' || coalesce(c.context, '')
+                                                             || '\n QUESTION: ' || q.question || '\n Answer: '}],
+                                             {}) as output
+            from batch_questions q
+            left join context c on c.question_id = q.question_id
+        )
+        select ?, question_id, question, ?,
+               trim(get(output:choices,0):messages,'" '), sources, top_similarity,
+               output:usage:prompt_tokens::int, output:usage:completion_tokens::int,
+               output:usage:total_tokens::int
+        from answered""",
+
+    "batch_summary": """
+        select count(*) as answers, sum(total_tokens) as total_tokens,
+               avg(top_similarity) as avg_top_similarity
+        from {table}
+        where run_id = ?""",
+
+    #### ------ answer warm-up (warmup.py) ------ ####
+
+    # most asked questions of the last ? days with their feedback, only those embedded
+    "warmup_recent_questions": """
+        with recent as (
+            select query as question, count(*) as asked,
+                   count_if(feedback = 'Yes') as positive,
+                   count_if(feedback = 'No') as negative
+            from {log_table}
+            where query is not null
+              and try_to_timestamp_tz(timestamp, 'YYYY-MM-DD HH24:MI:SS.FF3 TZHTZM')
+                  > dateadd(day, -?, current_timestamp())
+            group by query
+            qualify row_number() over (order by asked desc, positive desc) <= ?
+        )
+        select question, asked, positive, negative,
+               snowflake.cortex.embed_text_768('e5-base-v2', question)::array as qvec
+        from recent""",
+
+    # answers of a warm-up run, from the batch tables of the same session
+    "precomputed_publish": """
+        insert into {table} (run_id, model, question, qvec, response, pdf_relative_path,
+                             asked, positive_feedback)
+        with top_chunk as (
+            select question_id, max_by(relative_path, similarity) as relative_path
+            from batch_context
+            group by question_id
+        ),
+        clusters as (
+            select value[0]::varchar as question_id, value[1]::int as asked,
+                   value[2]::int as positive_feedback
+            from table(flatten(parse_json(?)))
+        )
+        select b.run_id, b.model, b.question, q.qvec, b.response, t.relative_path,
+               c.asked, c.positive_feedback
+        from {batch_table} b
+        join batch_questions q on q.question_id = b.question_id
+        left join top_chunk t on t.question_id = b.question_id
+        left join clusters c on c.question_id = b.question_id
+        where b.run_id = ? and b.response is not null""",
+
+    "precomputed_prune": """
+        delete from {table} where run_id <> ?""",
+
+    "precomputed_load": """
+        select model, question, qvec::array as qvec, response, pdf_relative_path
+        from {table}""",
+
+    #### ------ logging tables (log_writer.py, tracing.py, model_router.py) ------ ####
+
+    # one row per turn; feedback for a turn already written is merged into its row
+    "chat_log_merge": """
+        merge into {table} t
+        using (select value[0]::varchar as timestamp, value[1]::varchar as session_id,
+                      value[2]::int as query_seq, value[3]::varchar as user_name,
+                      value[4]::varchar as query, value[5]::varchar as response,
+                      value[6]::varchar as feedback, value[7]::varchar as suggestion
+               from table(flatten(parse_json(?)))) s
+        on t.session_id = s.session_id and t.query_seq = s.query_seq
+        when matched then update set
+             feedback = coalesce(s.feedback, t.feedback),
+             suggestion = coalesce(s.suggestion, t.suggestion)
+        when not matched and s.query is not null then insert
+             (timestamp, session_id, query_seq, user_name, query, response, feedback, suggestion)
+             values (s.timestamp, s.session_id, s.query_seq, s.user_name,
+                     s.query, s.response, s.feedback, s.suggestion)""",
+
+    "trace_insert": """
+        insert into {table}
+             (timestamp, session_id, query_seq, span_id, parent_id, stage, start_ms,
+              duration_ms, sql_count, tokens, credits, model, status)
+        select value[0]::varchar, value[1]::varchar, value[2]::int, value[3]::int,
+               value[4]::int, value[5]::varchar, value[6]::float, value[7]::float,
+               value[8]::int, value[9]::int, value[10]::float, value[11]::varchar,
+               value[12]::varchar
+        from table(flatten(parse_json(?)))""",
+
+    "routing_insert": """
+        insert into {table}
+             (timestamp, session_id, query_seq, mode, model, escalated_from, complexity,
+              confidence, quality, reason, complete_ms, tokens, credits)
+        select value[0]::varchar, value[1]::varchar, value[2]::int, value[3]::varchar,
+               value[4]::varchar, value[5]::varchar, value[6]::float, value[7]::float,
+               value[8]::int, value[9]::varchar, value[10]::float, value[11]::int,
+               value[12]::float
+        from table(flatten(parse_json(?)))""",
+}
+
+
+_stats = {}    # name -> {"calls", "prepare_secs", "execute_secs", "last_execute_secs"}
+_stats_lock = threading.Lock()
+
+
+def statement(name, **identifiers):
+    text = STATEMENTS[name]
+    for key, value in identifiers.items():
+        text = text.replace("{%s}" % key, value)
+    return text
+
+
+def _record(name, prepare_secs, execute_secs):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {"calls": 0, "prepare_secs": 0.0, "execute_secs": 0.0,
+                                         "last_execute_secs": 0.0})
+        stats["calls"] += 1
+        stats["prepare_secs"] += prepare_secs
+        stats["execute_secs"] += execute_secs
+        stats["last_execute_secs"] = execute_secs
+
+
+def run(session, name, *params, method="collect", **identifiers):
+    # runs a named statement and returns df.<method>(), the rows by default
+    text = statement(name, **identifiers)
+    start = time.perf_counter()
+    df = session.sql(text, params=list(params)) if params else session.sql(text)
+    prepared = time.perf_counter()
+    result = getattr(df, method)()
+    _record(name, prepared - start, time.perf_counter() - prepared)
+    return result
+
+
+def statement_stats():
+    # client side view: calls and average prepare / execute ms per statement
+    with _stats_lock:
+        return {name: {"calls": s["calls"],
+                       "avg_prepare_ms": round(1000 * s["prepare_secs"] / s["calls"], 1),
+                       "avg_execute_ms": round(1000 * s["execute_secs"] / s["calls"], 1),
+                       "last_execute_ms": round(1000 * s["last_execute_secs"], 1)}
+                for name, s in sorted(_stats.items())}
+
+
+def server_stats(session, names=None, **identifiers):
+    # compile and execution time Snowflake reports for the named statements run by
+    # this session; a repeated request answered from the result cache shows ~0 execution
+    texts = {statement(name, **identifiers).strip(): name for name in (names or STATEMENTS)}
+    rows = session.sql("""
+        select trim(query_text) as query_text,
+               count(*) as calls,
+               avg(compilation_time) as avg_compile_ms,
+               avg(execution_time) as avg_execute_ms,
+               avg(total_elapsed_time) as avg_total_ms
+        from table(information_schema.query_history_by_session(result_limit => 1000))
+        where trim(query_text) in (select value::varchar from table(flatten(parse_json(?))))
+        group by 1
+    """, params=[json.dumps(list(texts))]).collect()
+    return {texts[row.QUERY_TEXT]: {"calls": row.CALLS,
+                                    "avg_compile_ms": row.AVG_COMPILE_MS,
+                                    "avg_execute_ms": row.AVG_EXECUTE_MS,
+                                    "avg_total_ms": row.AVG_TOTAL_MS}
+            for row in rows if row.QUERY_TEXT in texts}
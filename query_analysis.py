@@ -0,0 +1,145 @@
+#### ------ Query analysis: one structured call per question ------ ####
+#
+# One small-model COMPLETE returns, as JSON, everything the pipeline used to
+# ask separate LLM calls for:
+#
+#   search_query     the question within 128 characters and self-contained,
+#                    for snowdoc_search
+#   retrieval_query  the question made self-contained with the chat history,
+#                    for the knowledge base search (follow-ups without the
+#                    rolling summary only)
+#   demo_keyword     the feature / use case / workload named in the question,
+#                    for the YouTube demos link
+#
+# Only the keys that are needed are asked for, and no call is made when none
+# is (a short first question). Results are cached per question and
+# conversation context, so repeated questions cost nothing. The demo keyword
+# only rides along on a call made anyway, and is read from the cache when the
+# answer is rendered instead of calling llama3-70b after the answer.
+
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from answer_cache import history_fingerprint
+from queries import run
+from tracing import add_tokens
+
+
+FIELDS = {
+    "search_query": "the question, self-contained using the conversation so far, rewritten to be within {max_chars} characters, to search the Snowflake documentation",
+    "retrieval_query": "the question made self-contained using the conversation so far, in natural language, high level, less than 20 words",
+    "demo_keyword": "the name of the Snowflake key feature, use case or workload mentioned directly in the question, or \"no\"",
+}
+
+
+def parse_analysis(text):
+    # the JSON object in the model output, tolerating code fences and chatter around it
+    match = re.search(r"\{.*\}", text or "", re.S)
+    if not match:
+        return {}
+    try:
+        parsed = json.loads(match.group(0))
+    except ValueError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    return {k: str(v).strip() for k, v in parsed.items() if k in FIELDS and v}
+
+
+class QueryAnalyzer:
+
+    def __init__(self, session, model='llama3-8b', max_chars=128, max_entries=1024):
+        self.session = session
+        self.model = model
+        self.max_chars = max_chars
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._queries = OrderedDict()    # (question, context fingerprint) -> {search_query, retrieval_query}
+        self._keywords = OrderedDict()   # question -> demo_keyword
+        self.calls = 0
+        self.cache_hits = 0
+
+    def _get(self, cache, key):
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def _put(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+    def _prompt(self, question, context, fields):
+        keys = "\n".join(f'"{field}": {FIELDS[field].format(max_chars=self.max_chars)}' for field in fields)
+        return f"""
+            Analyze the user question about Snowflake. Answer with one JSON object only, with these keys:
+            {keys}
+
+            CONVERSATION SO FAR: {context or '(none)'}
+            QUESTION: {question}
+            """
+
+    def analyze(self, question, context="", retrieval=False, demo_keyword=True):
+        # context is the chat history or the rolling summary of a follow-up.
+        # Returns {search_query, retrieval_query, demo_keyword}; anything not needed
+        # or not returned by the model falls back to the question
+        long_question = len(question) > self.max_chars
+        key = (question, history_fingerprint(context))
+
+        with self._lock:
+            queries = dict(self._get(self._queries, key) or {})
+            keyword = self._get(self._keywords, question)
+
+        fields = []
+        if (long_question or context) and "search_query" not in queries:
+            fields.append("search_query")
+        if retrieval and context and "retrieval_query" not in queries:
+            fields.append("retrieval_query")
+        if fields and long_question and demo_keyword and keyword is None:
+            # never worth a call of its own
+            fields.append("demo_keyword")
+
+        if fields:
+            response = run(self.session, 'analyze_question', self.model,
+                           self._prompt(question, context, fields))[0]
+            add_tokens(response.TOTAL_TOKENS, self.model)
+            result = parse_analysis(response.RESPONSE)
+            queries.update({k: v for k, v in result.items() if k != "demo_keyword"})
+            with self._lock:
+                self.calls += 1
+                self._put(self._queries, key, queries)
+                if "demo_keyword" in result:
+                    keyword = result["demo_keyword"]
+                    self._put(self._keywords, question, keyword)
+        elif long_question or context:
+            with self._lock:
+                self.cache_hits += 1
+
+        search_query = queries.get("search_query", question) if (long_question or context) else question
+        return {"search_query": search_query[:self.max_chars],
+                "retrieval_query": queries.get("retrieval_query", question) if retrieval else question,
+                "demo_keyword": self.keyword(question)}
+
+    def keyword(self, question):
+        # demo keyword from the cache, never a call; the question itself otherwise
+        with self._lock:
+            keyword = self._get(self._keywords, question)
+        if keyword and keyword.strip(' ."').lower() != "no":
+            return keyword
+        return question[:self.max_chars]
+
+    def remember(self, question, demo_keyword):
+        # e.g. the keyword stored with a cached answer
+        if demo_keyword and demo_keyword != question[:self.max_chars]:
+            with self._lock:
+                self._put(self._keywords, question, demo_keyword)
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "cache_hits": self.cache_hits,
+                    "queries": len(self._queries), "keywords": len(self._keywords)}
@@ -22,60 +22,70 @@ ls @docs;
 
 
 // Create UDF pdf_text_chunker
+-- Reads the pdf page by page and yields chunks as soon as they are full, carrying the
+-- overlap across page boundaries, so memory is bounded by the chunk size rather than
+-- the document size. Each chunk is returned with the page it starts on.
 create or replace function pdf_text_chunker(file_url string, size integer, overlap integer)
-returns table (chunk varchar)
+returns table (chunk varchar, page_number integer)
 language python
 runtime_version = '3.9'
 handler = 'pdf_text_chunker'
-packages = ('snowflake-snowpark-python','PyPDF2', 'langchain')
+packages = ('snowflake-snowpark-python','PyPDF2')
 as
 $$
-from snowflake.snowpark.types import StringType, IntegerType, StructField, StructType
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from snowflake.snowpark.files import SnowflakeFile
-import PyPDF2, io
+import PyPDF2
 import logging
-import pandas as pd
 
 class pdf_text_chunker:
 
-    def read_pdf(self, file_url: str) -> str:
+    def read_pages(self, file, file_url: str):
     
         logger = logging.getLogger("udf_logger")
         logger.info(f"Opening file {file_url}")
-    
-        text = ""
-        with SnowflakeFile.open(file_url, 'rb') as file:
-            f = io.BytesIO(file.readall())
-            pdf_reader = PyPDF2.PdfFileReader(f)
-            text = ""
-            for page in pdf_reader.pages:
-                try:
-                    text += page.extract_text().replace('\n', ' ').replace('\0', ' ')
-                except:
-                    text = "Unable to Extract"
-                    logger.warn(f"Unable to extract from file {file_url}, page {page}")
-        return text
+
+        pdf_reader = PyPDF2.PdfFileReader(file)   # reads objects on demand, the file is seekable
+        for page_number, page in enumerate(pdf_reader.pages, start = 1):
+            try:
+                yield page_number, page.extract_text().replace('\n', ' ').replace('\0', ' ')
+            except:
+                # skip only the page that fails
+                logger.warn(f"Unable to extract from file {file_url}, page {page_number}")
+
+    def split_point(self, text, size, overlap):
+        # cut on the last space before size, like the recursive splitter did on text without newlines
+        cut = text.rfind(' ', overlap + 1, size)
+        return cut if cut > 0 else size
 
     def process(self, file_url: str, size, overlap):
 
-        text = self.read_pdf(file_url)
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            #separators = ["\n"],
-            chunk_size = size,   #Adjust this as you see fit
-            chunk_overlap  = overlap,   #This let's text have some form of overlap. Useful for keeping chunks contextual
-            length_function = len
-            #add_start_index = True #Optional but useful if you'd like to feed the chunk before/after
-        )
-    
-        #chunks = text_splitter.create_documents(text)
-        #df = pd.DataFrame(chunks, columns=['chunks', 'meta'])
+        buffer = ""        # text not emitted yet, at most size plus one page
+        page_starts = []   # (offset in buffer, page number) for each page in the buffer
+        carried = 0        # leading characters of buffer already emitted as overlap
 
-        chunks = text_splitter.split_text(text)
-        df = pd.DataFrame(chunks, columns=['chunks'])
-        
-        yield from df.itertuples(index=False, name=None)
+        with SnowflakeFile.open(file_url, 'rb') as file:
+            for page_number, text in self.read_pages(file, file_url):
+                page_starts.append((len(buffer), page_number))
+                buffer += text + ' '
+
+                while len(buffer) >= size:
+                    cut = self.split_point(buffer, size, overlap)
+                    chunk = buffer[:cut].strip()
+                    if chunk:
+                        yield (chunk, page_starts[0][1])
+
+                    # keep the last overlap characters, starting on a word
+                    start = cut - overlap if cut > overlap else cut
+                    space = buffer.find(' ', start, cut)
+                    start = space + 1 if space >= 0 else start
+                    buffer = buffer[start:]
+                    carried = cut - start
+                    page_starts = [(max(offset - start, 0), page) for offset, page in page_starts]
+                    while len(page_starts) > 1 and page_starts[1][0] == 0:
+                        page_starts.pop(0)
+
+        if len(buffer) > carried and buffer.strip():
+            yield (buffer.strip(), page_starts[0][1])
 $$
 ;
 
@@ -88,26 +98,135 @@ create or replace table DOCS_CHUNKS_TABLE (
     FILE_URL VARCHAR(16777216), -- URL for the PDF
     SCOPED_FILE_URL VARCHAR(16777216), -- Scoped url (you can choose which one to keep depending on your use case)
     CHUNK VARCHAR(16777216), -- Piece of text
-    CHUNK_VEC VECTOR(FLOAT, 768)  -- Embedding using the VECTOR data type
+    CHUNK_VEC VECTOR(FLOAT, 768),  -- Embedding using the VECTOR data type
+    PAGE_NUMBER NUMBER(38,0), -- Page of the PDF the chunk starts on
+    CHUNK_HASH VARCHAR(64), -- SHA2 of the chunk text, an unchanged chunk is never embedded twice
+    CHUNK_SIZE NUMBER(38,0), -- Chunking parameters the chunk was produced with
+    CHUNK_OVERLAP NUMBER(38,0),
+    CREATED_AT TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP(),  -- Load time, lets the app's in-memory index pick up new rows incrementally
+    CLUSTER_ID NUMBER(38,0)  -- Vector partition (nearest centroid in docs_chunk_centroids), null until assigned
 )
+cluster by (CLUSTER_ID)  -- a partition sits in a few micro-partitions, a probed search reads only those
 ;  
 
+-- k-means centroids of chunk_vec for the partitioned search in Snowflake (see partition_docs below)
+create or replace table DOCS_CHUNK_CENTROIDS (
+    CLUSTER_ID NUMBER(38,0),
+    CENTROID VECTOR(FLOAT, 768),
+    TRAINED_SIZE NUMBER(38,0)  -- chunks in docs_chunks_table when trained, retrained once it has doubled
+)
+;
+
 
--- insert doc chunks
-insert into docs_chunks_table (relative_path, size_mb, file_url,
-                            scoped_file_url, chunk, chunk_vec)
-    select relative_path, 
-            round(size / 1000000, 2) as size_mb,
-            file_url, 
-            build_scoped_file_url(@docs, relative_path) as scoped_file_url,
-            func.chunk as chunk,
-            snowflake.cortex.embed_text_768('e5-base-v2',chunk) as chunk_vec
-    from 
-        directory(@docs),
-        TABLE(pdf_text_chunker(build_scoped_file_url(@docs, relative_path), 2000, 300)) as func
+-- Incremental ingestion: chunk new or changed files, embed only the chunks whose hash is not
+-- stored yet, merge them in, and drop the chunks of deleted or replaced files.
+-- from_stream = true processes the changes in docs_stream, false the whole stage.
+create or replace procedure ingest_docs(chunk_size integer, chunk_overlap integer, from_stream boolean)
+returns varchar
+language sql
+as
+$$
+declare
+    embedded integer default 0;
+    merged integer default 0;
+    has_partition_docs integer default 0;
+    partitioned varchar default 'not partitioned';
+begin
+    create or replace temporary table changed_files (
+        relative_path varchar, size number, file_url varchar, action varchar
+    );
+
+    if (from_stream) then
+        insert into changed_files
+            select relative_path, size, file_url, metadata$action from docs_stream;
+    else
+        insert into changed_files
+            select relative_path, size, file_url, 'INSERT' from directory(@docs);
+    end if;
+
+    create or replace temporary table new_chunks as
+        select f.relative_path,
+               round(f.size / 1000000, 2) as size_mb,
+               f.file_url,
+               build_scoped_file_url(@docs, f.relative_path) as scoped_file_url,
+               func.chunk as chunk,
+               func.page_number as page_number,
+               sha2(func.chunk, 256) as chunk_hash
+        from changed_files f,
+             TABLE(pdf_text_chunker(build_scoped_file_url(@docs, f.relative_path), :chunk_size, :chunk_overlap)) as func
+        where f.action = 'INSERT';
+
+    -- reuse the vectors of chunks already stored, embed the rest
+    create or replace temporary table chunk_vecs as
+        select chunk_hash, chunk_vec
+        from docs_chunks_table
+        where chunk_hash in (select chunk_hash from new_chunks)
+        qualify row_number() over (partition by chunk_hash order by created_at) = 1;
+
+    insert into chunk_vecs
+        select chunk_hash, snowflake.cortex.embed_text_768('e5-base-v2', chunk) as chunk_vec
+        from (select chunk_hash, any_value(chunk) as chunk
+              from new_chunks
+              where chunk_hash not in (select chunk_hash from chunk_vecs)
+              group by chunk_hash);
+    embedded := SQLROWCOUNT;
+
+    -- files removed from the stage
+    if (from_stream) then
+        delete from docs_chunks_table
+        where relative_path in (select relative_path from changed_files where action = 'DELETE')
+          and relative_path not in (select relative_path from changed_files where action = 'INSERT');
+    else
+        delete from docs_chunks_table
+        where relative_path not in (select relative_path from changed_files);
+    end if;
+
+    -- chunks that are no longer part of a re-uploaded file
+    delete from docs_chunks_table d
+    where d.relative_path in (select relative_path from changed_files where action = 'INSERT')
+      and not exists (select 1 from new_chunks n
+                      where n.relative_path = d.relative_path and n.chunk_hash = d.chunk_hash);
+
+    merge into docs_chunks_table d
+    using (select n.*, v.chunk_vec
+           from new_chunks n join chunk_vecs v on v.chunk_hash = n.chunk_hash
+           qualify row_number() over (partition by n.relative_path, n.chunk_hash order by n.chunk_hash) = 1) s
+    on d.relative_path = s.relative_path and d.chunk_hash = s.chunk_hash
+    when matched then update set
+        size_mb = s.size_mb, file_url = s.file_url, scoped_file_url = s.scoped_file_url,
+        page_number = s.page_number, chunk_size = :chunk_size, chunk_overlap = :chunk_overlap
+    when not matched then insert
+        (relative_path, size_mb, file_url, scoped_file_url, chunk, chunk_vec, page_number,
+         chunk_hash, chunk_size, chunk_overlap)
+        values (s.relative_path, s.size_mb, s.file_url, s.scoped_file_url, s.chunk, s.chunk_vec,
+                s.page_number, s.chunk_hash, :chunk_size, :chunk_overlap);
+    merged := SQLROWCOUNT;
+
+    -- put the new chunks in their vector partition, once partition_docs is set up below.
+    -- A failure does not undo the load, it is reported in the result
+    select count(*) into :has_partition_docs
+    from information_schema.procedures
+    where procedure_schema = current_schema() and procedure_name = 'PARTITION_DOCS';
+
+    if (has_partition_docs > 0) then
+        begin
+            call partition_docs(0, false) into :partitioned;
+        exception
+            when other then
+                partitioned := 'partition_docs failed: ' || sqlerrm;
+        end;
+    end if;
+
+    return 'embedded ' || embedded || ' new chunks, merged ' || merged || ' rows, ' || partitioned;
+end;
+$$
 ;
 
 
+-- insert doc chunks (the same 2000/300 chunking is used by the task below)
+call ingest_docs(2000, 300, false);
+
+
 -- Check it out
 select * from docs_chunks_table limit 5;
 
@@ -134,48 +253,68 @@ ALLOWED_NETWORK_RULES = (snowdoc_network_rule)
 ENABLED = true;
 
 
--- Create UDF that scrapes Snowflake Documentation through Search Bar
-CREATE OR REPLACE FUNCTION snowdoc_search(topic STRING)
+-- Page cache for snowdoc_search: extracted article text per url, revalidated with ETag / Last-Modified
+create table if not exists snowdoc_page_cache (
+    URL VARCHAR,
+    TEXT VARCHAR,
+    ETAG VARCHAR,
+    LAST_MODIFIED VARCHAR,
+    FETCHED_AT TIMESTAMP_LTZ
+)
+;
+
+
+-- Stage for the Python code used by the procedures below
+create stage if not exists code 
+ENCRYPTION = (TYPE = 'SNOWFLAKE_SSE')
+;
+
+-- Upload snowdoc_scraper.py from this repo to the stage code
+-- e.g. PUT file://snowdoc_scraper.py @code AUTO_COMPRESS = FALSE OVERWRITE = TRUE;
+ls @code;
+
+
+-- Create procedure that scrapes Snowflake Documentation through Search Bar
+-- (a procedure rather than a UDF so it can read and write snowdoc_page_cache)
+CREATE OR REPLACE PROCEDURE snowdoc_search(topic STRING)
 RETURNS ARRAY
 LANGUAGE PYTHON
 RUNTIME_VERSION = 3.9
-HANDLER = 'get_links'
+HANDLER = 'snowdoc_scraper.snowdoc_search'
+IMPORTS = ('@code/snowdoc_scraper.py')
 EXTERNAL_ACCESS_INTEGRATIONS = (snow_doc_access_integration)
-PACKAGES = ('requests', 'beautifulsoup4')
+PACKAGES = ('snowflake-snowpark-python', 'requests', 'beautifulsoup4')
 --SECRETS = ('cred' = oauth_token )
-AS
-$$
-import _snowflake
-import requests
-from bs4 import BeautifulSoup
-
-def get_links(keyword):
-  url = f"https://docs.snowflake.com/search?q={keyword}"
-  response = requests.get(url)
-  soup = BeautifulSoup(response.text, 'html.parser')
-  matches = ["-guide/", "collaboration", "sql-reference"]
-  links = [link.get("href") for link in soup.find_all("a") if any(x in link.get('href') for x in matches)]
-
-  try:
-      response2 = requests.get(links[0])
-      soup2 = BeautifulSoup(response2.text)
-      
-      response3 = requests.get(links[1])
-      soup3 = BeautifulSoup(response3.text)
-
-      result = soup2.get_text() + ' ' + soup3.get_text()
-      
-      return [result.replace('\n', ' '), links[0]+ ', ' +links[1]]
-  except:
-      return []
-$$
 ;
 
 
--- Test function
-select snowdoc_search('What is Cortex AI?') as output,
-       output[0] as response,
-       output[1] as reference_url      
+-- Test procedure
+call snowdoc_search('What is Cortex AI?');
+
+select * from snowdoc_page_cache order by fetched_at desc;
+
+
+
+// Partitioned vector search in Snowflake, for knowledge bases too large for the app's memory
+// (server_index = 1 in app.py, see vector_partitions.py)
+
+-- Upload vector_partitions.py, vector_index.py and queries.py to the stage code
+CREATE OR REPLACE PROCEDURE partition_docs(lists INTEGER, rebuild BOOLEAN)
+RETURNS VARCHAR
+LANGUAGE PYTHON
+RUNTIME_VERSION = 3.9
+HANDLER = 'vector_partitions.partition_docs'
+IMPORTS = ('@code/vector_partitions.py', '@code/vector_index.py', '@code/queries.py')
+PACKAGES = ('snowflake-snowpark-python', 'numpy', 'pandas')
+;
+
+-- about sqrt(chunks) lists; ingest_docs assigns new chunks and retrains when the table has doubled
+call partition_docs(64, true);
+
+select cluster_id, count(*) as chunks
+from docs_chunks_table
+group by cluster_id
+order by chunks desc
 ;
 
 
@@ -190,17 +329,7 @@ create or replace task task_extract_chunk_vec_from_pdf
     when system$stream_has_data('docs_stream')
     as
 
-    insert into docs_chunks_table (relative_path, size_mb, file_url,
-                                scoped_file_url, chunk, chunk_vec)
-        select relative_path, 
-                round(size / 1000000, 2) as size_mb,
-                file_url, 
-                build_scoped_file_url(@docs, relative_path) as scoped_file_url,
-                func.chunk as chunk,
-                snowflake.cortex.embed_text_768('e5-base-v2',chunk) as chunk_vec
-        from 
-            docs_stream,
-            TABLE(pdf_text_chunker(build_scoped_file_url(@docs, relative_path), 3000, 300)) as func;
+    call ingest_docs(2000, 300, true);
         
 
 alter task task_extract_chunk_vec_from_pdf resume;
@@ -237,4 +366,166 @@ order by timestamp desc
 
 
 
+// Per-stage trace of every chat turn (wall clock, SQL statements, tokens, credits), written in batches by the app
+
+create table if not exists chat_trace (
+    TIMESTAMP VARCHAR,  -- start of the turn, client side
+    SESSION_ID VARCHAR,
+    QUERY_SEQ INT,
+    SPAN_ID INT,
+    PARENT_ID INT,  -- null for the 'turn' span
+    STAGE VARCHAR,  -- turn, embed, answer_cache, summary, retrieval, rewrite, snowdoc_search, vector_search, presign, complete, log_write, ...
+    START_MS FLOAT,  -- offset from the start of the turn
+    DURATION_MS FLOAT,  -- null if the stage was still running when the turn ended
+    SQL_COUNT INT,
+    TOKENS INT,
+    CREDITS FLOAT,
+    MODEL VARCHAR,
+    STATUS VARCHAR  -- ok, error, timeout
+)
+;
+
+-- where the seconds and credits go, per stage
+select stage,
+       count(*) as spans,
+       approx_percentile(duration_ms, 0.5) as p50_ms,
+       approx_percentile(duration_ms, 0.95) as p95_ms,
+       avg(sql_count) as avg_sql,
+       sum(tokens) as tokens,
+       sum(credits) as credits,
+       count_if(status <> 'ok') as degraded
+from chat_trace
+group by stage
+order by p95_ms desc
+;
+
+
+
+// Model of every answer, picked by the router ('auto' model) or fixed, with its latency and credits (model_router.py)
+
+create table if not exists model_routing (
+    TIMESTAMP VARCHAR,
+    SESSION_ID VARCHAR,
+    QUERY_SEQ INT,
+    MODE VARCHAR,  -- auto or fixed
+    MODEL VARCHAR,  -- model of the final answer
+    ESCALATED_FROM VARCHAR,  -- model whose answer declined, if any
+    COMPLEXITY FLOAT,  -- 0..1, auto only
+    CONFIDENCE FLOAT,  -- best chunk similarity, auto only
+    QUALITY INT,  -- quality level asked for
+    REASON VARCHAR,
+    COMPLETE_MS FLOAT,  -- every completion of the answer, escalation included
+    TOKENS INT,
+    CREDITS FLOAT
+)
+;
+
+-- auto against fixed models: credits, answer time and feedback per answer
+select r.mode, r.model,
+       count(*) as answers,
+       avg(r.credits) as avg_credits,
+       approx_percentile(r.complete_ms, 0.5) as p50_complete_ms,
+       avg(t.duration_ms) as avg_turn_ms,
+       count_if(r.escalated_from is not null) as escalations,
+       count_if(l.feedback = 'Yes') as yes,
+       count_if(l.feedback = 'No') as no
+from model_routing r
+left join chat_trace t on t.session_id = r.session_id and t.query_seq = r.query_seq and t.stage = 'turn'
+left join chat_history_log l on l.session_id = r.session_id and l.query_seq = r.query_seq
+group by r.mode, r.model
+order by r.mode, avg_credits
+;
+
+
+// Shared semantic answer cache (set answer_cache_table = 'ANSWER_CACHE' in app.py to use it)
+
+create table if not exists answer_cache (
+    SCOPE VARCHAR,  -- model | knowledge base mode | chat history fingerprint
+    QUESTION VARCHAR,
+    QVEC VECTOR(FLOAT, 768),  -- question embedding (e5-base-v2)
+    PAYLOAD VARIANT,  -- response, reference_url, pdf_relative_path
+    CREATED_AT TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP()
+)
+;
+
+-- expired answers are ignored by the app, clean them up from time to time
+delete from answer_cache where created_at < dateadd(day, -1, current_timestamp());
+
+
+
+// Batch question answering results (python batch_qa.py --questions-table ... / --questions-file ...)
+
+create table if not exists batch_answers (
+    RUN_ID VARCHAR,
+    QUESTION_ID VARCHAR,
+    QUESTION VARCHAR,
+    MODEL VARCHAR,
+    RESPONSE VARCHAR,
+    SOURCES ARRAY,  -- relative paths of the chunks in the context
+    TOP_SIMILARITY FLOAT,
+    PROMPT_TOKENS INT,
+    COMPLETION_TOKENS INT,
+    TOTAL_TOKENS INT,
+    CREATED_AT TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP()
+)
+;
 
+-- compare two runs, e.g. before and after a doc upload or with another model
+select a.question_id, a.question, a.response as response_a, b.response as response_b,
+       a.top_similarity as similarity_a, b.top_similarity as similarity_b
+from batch_answers a
+join batch_answers b on b.question_id = a.question_id
+where a.run_id = '<run a>' and b.run_id = '<run b>'
+order by similarity_b - similarity_a
+;
+
+
+
+// Answers to the most asked questions, precomputed daily from chat_history_log (warmup.py)
+// and loaded by the app into its answer cache (precomputed_table in app.py)
+
+create table if not exists precomputed_answers (
+    RUN_ID VARCHAR,  -- each warm-up run replaces the previous one
+    MODEL VARCHAR,
+    QUESTION VARCHAR,  -- the best rated question of a cluster of similar questions
+    QVEC VECTOR(FLOAT, 768),
+    RESPONSE VARCHAR,
+    PDF_RELATIVE_PATH VARCHAR,  -- source of the top knowledge base chunk
+    ASKED INT,  -- times the questions of the cluster were asked
+    POSITIVE_FEEDBACK INT,
+    CREATED_AT TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP()
+)
+;
+
+-- Upload warmup.py, queries.py, prompt_budget.py, completion.py and vector_index.py to the stage code
+-- e.g. PUT file://warmup.py @code AUTO_COMPRESS = FALSE OVERWRITE = TRUE;
+CREATE OR REPLACE PROCEDURE warm_answers(models ARRAY, top_n INTEGER, days INTEGER)
+RETURNS VARIANT
+LANGUAGE PYTHON
+RUNTIME_VERSION = 3.9
+HANDLER = 'warmup.warm_answers'
+IMPORTS = ('@code/warmup.py', '@code/queries.py', '@code/prompt_budget.py',
+           '@code/completion.py', '@code/vector_index.py')
+PACKAGES = ('snowflake-snowpark-python', 'numpy', 'pandas')
+EXECUTE AS CALLER  -- the batch statements use temporary tables
+;
+
+-- null models: every model offered in the app
+create or replace task task_warm_answers
+    warehouse = SMALL_WH
+    schedule = 'USING CRON 0 6 * * * UTC'
+    as
+
+    call warm_answers(null, 20, 7);
+
+
+alter task task_warm_answers resume;
+
+alter task task_warm_answers suspend;
+
+EXECUTE TASK task_warm_answers;
+
+select model, question, asked, positive_feedback, created_at
+from precomputed_answers
+order by asked desc, model
+;
@@ -0,0 +1,187 @@
+#### ------ Snowflake documentation scraper behind snowdoc_search ------ ####
+#
+# Uploaded to @code and used as the handler of the snowdoc_search stored
+# procedure (see setup.sql). Searches docs.snowflake.com, then fetches the top
+# result pages concurrently over one pooled HTTP session. Extracted page text
+# is cached per URL together with its ETag / Last-Modified headers, in memory
+# and in the SNOWDOC_PAGE_CACHE table, and revalidated with conditional
+# requests so unchanged pages are neither downloaded nor parsed again.
+#
+# Nothing here needs Snowflake except TablePageCache: search() can be pointed
+# at a local HTTP server through base_url.
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urljoin
+
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+BASE_URL = "https://docs.snowflake.com"
+MATCHES = ["-guide/", "collaboration", "sql-reference"]
+NUM_PAGES = 2
+TIMEOUT_SECS = 10
+MAX_AGE_SECS = 3600     # cached pages younger than this are used without revalidating
+
+
+def make_http_session(pool_size=8):
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=Retry(total=2, backoff_factor=0.2,
+                                            status_forcelist=[502, 503, 504]))
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+
+def extract_main_text(html):
+    # only the article body, not the navigation, headers and footers around it
+    soup = BeautifulSoup(html, "html.parser")
+    main = (soup.find("article") or soup.find("main")
+            or soup.find(attrs={"role": "main"}) or soup.body or soup)
+    for tag in main.find_all(["script", "style", "nav", "header", "footer", "aside"]):
+        tag.decompose()
+    return " ".join(main.get_text(" ").split())
+
+
+def find_links(html, base_url=BASE_URL):
+    soup = BeautifulSoup(html, "html.parser")
+    links = []
+    for link in soup.find_all("a"):
+        href = link.get("href")
+        if href and any(x in href for x in MATCHES):
+            href = urljoin(base_url, href)
+            if href not in links:
+                links.append(href)
+    return links
+
+
+#### ------ page caches ------ ####
+
+class MemoryPageCache:
+# url -> {"text", "etag", "last_modified", "fetched_at"}
+
+    def __init__(self):
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, urls):
+        with self._lock:
+            return {url: self._pages[url] for url in urls if url in self._pages}
+
+    def put_many(self, pages):
+        with self._lock:
+            self._pages.update(pages)
+
+
+class TablePageCache:
+# Backed by the SNOWDOC_PAGE_CACHE table so every caller shares it, with the
+# process wide in-memory cache in front of it
+
+    def __init__(self, session, table="snowdoc_page_cache", memory=None):
+        self.session = session
+        self.table = table
+        self.memory = memory if memory is not None else _memory_cache
+
+    def get_many(self, urls):
+        pages = self.memory.get_many(urls)
+        missing = [url for url in urls if url not in pages]
+        if missing:
+            rows = self.session.sql(f"""
+                select url, text, etag, last_modified,
+                       date_part(epoch_second, fetched_at) as fetched_at
+                from {self.table}
+                where url in (select value::varchar from table(flatten(parse_json(?))))
+            """, params=[json.dumps(missing)]).collect()
+            loaded = {row.URL: {"text": row.TEXT, "etag": row.ETAG,
+                                "last_modified": row.LAST_MODIFIED,
+                                "fetched_at": float(row.FETCHED_AT)} for row in rows}
+            self.memory.put_many(loaded)
+            pages.update(loaded)
+        return pages
+
+    def put_many(self, pages):
+        if not pages:
+            return
+        self.memory.put_many(pages)
+        rows = [[url, page["text"], page["etag"], page["last_modified"], page["fetched_at"]]
+                for url, page in pages.items()]
+        # one MERGE for all pages fetched by this call
+        self.session.sql(f"""
+            merge into {self.table} t
+            using (select value[0]::varchar as url, value[1]::varchar as text,
+                          value[2]::varchar as etag, value[3]::varchar as last_modified,
+                          to_timestamp_ltz(value[4]::number) as fetched_at
+                   from table(flatten(parse_json(?)))) s
+            on t.url = s.url
+            when matched then update set text = s.text, etag = s.etag,
+                 last_modified = s.last_modified, fetched_at = s.fetched_at
+            when not matched then insert (url, text, etag, last_modified, fetched_at)
+                 values (s.url, s.text, s.etag, s.last_modified, s.fetched_at)
+        """, params=[json.dumps(rows)]).collect()
+
+
+_memory_cache = MemoryPageCache()
+
+
+#### ------ fetching ------ ####
+
+def fetch_page(http, url, cached=None, max_age_secs=MAX_AGE_SECS):
+    # returns (page, changed). A fresh cached page is returned as is, an older one
+    # is revalidated with If-None-Match / If-Modified-Since
+    now = time.time()
+    if cached and now - cached["fetched_at"] < max_age_secs:
+        return cached, False
+
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = http.get(url, headers=headers, timeout=TIMEOUT_SECS)
+    if response.status_code == 304 and cached:
+        return dict(cached, fetched_at=now), True
+    response.raise_for_status()
+
+    return {"text": extract_main_text(response.text),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": now}, True
+
+
+_http = make_http_session()
+
+
+def search(keyword, http=None, cache=None, base_url=BASE_URL, num_pages=NUM_PAGES,
+           max_age_secs=MAX_AGE_SECS):
+    # returns [text of the top pages, "url1, url2"], or [] when nothing was found
+    http = http or _http
+    cache = cache if cache is not None else _memory_cache
+
+    response = http.get(f"{base_url}/search?q={quote(keyword)}", timeout=TIMEOUT_SECS)
+    links = find_links(response.text, base_url)[:num_pages]
+    if len(links) < num_pages:
+        return []
+
+    cached = cache.get_many(links)
+    with ThreadPoolExecutor(max_workers=len(links)) as pool:
+        results = list(pool.map(lambda url: fetch_page(http, url, cached.get(url), max_age_secs), links))
+
+    cache.put_many({url: page for url, (page, changed) in zip(links, results) if changed})
+
+    text = " ".join(page["text"] for page, _ in results)
+    return [text.replace("\n", " "), ", ".join(links)]
+
+
+def snowdoc_search(session, topic):
+    # stored procedure handler
+    try:
+        return search(topic, cache=TablePageCache(session))
+    except Exception:
+        return []
@@ -0,0 +1,142 @@
+#### ------ Stage scheduler for the retrieval pipeline ------ ####
+#
+# Runs the round-trips behind one question (rewrite, snowdoc_search, embed,
+# vector search, presign, ...) as a small dependency graph on a thread pool,
+# so independent stages overlap instead of adding up. A stage can be given a
+# timeout and a default: when it is too slow or fails, its dependents carry on
+# with the default instead of blocking the answer. When a trace is open (see
+# tracing.py) every stage runs in its own span, under the span that ran the graph.
+#
+# A stage's timeout counts from when it starts running, not from when it is
+# queued. Fire-and-forget work (summary updates, cache writes, refreshes) runs
+# on a pool of its own, so it never queues in front of a user's question.
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from tracing import current_span, current_trace
+
+
+_pool = None
+_background_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(max_workers=32):
+    # one pool per process, shared by every session; timed out stages keep their
+    # thread until the query returns, so it is sized for several slow doc searches
+    # per concurrent question on top of the stages of the questions themselves
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage")
+    return _pool
+
+
+def get_background_pool(max_workers=8):
+    # work nobody waits for: summary updates, cache writes and reloads, url refreshes
+    global _background_pool
+    with _pool_lock:
+        if _background_pool is None:
+            _background_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="background")
+    return _background_pool
+
+
+class Stage:
+
+    def __init__(self, name, fn, deps=(), timeout=None, default=None, optional=None):
+        # fn is called with the results of deps, in order
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.timeout = timeout
+        self.default = default
+        # a stage with a timeout degrades to its default on errors as well
+        self.optional = timeout is not None if optional is None else optional
+
+
+class StageScheduler:
+
+    def __init__(self, stages, pool=None):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            missing = [d for d in stage.deps if d not in self.stages]
+            if missing:
+                raise ValueError(f"Stage {stage.name} depends on unknown stages {missing}")
+        self.pool = pool or get_pool()
+        self.results = {}
+        self.timings = {}     # name -> seconds, wall clock of the stage itself
+        self.degraded = {}    # name -> 'timeout' or the exception raised
+        self.started = {}     # name -> perf_counter when a pool thread picked the stage up
+        # stages run on pool threads, so the trace and parent span are taken from here
+        self.trace = current_trace()
+        self.parent_span = current_span()
+
+    def _timed(self, stage, args):
+        start = self.started[stage.name] = time.perf_counter()
+        try:
+            if self.trace is None:
+                return stage.fn(*args)
+            with self.trace.span(stage.name, parent=self.parent_span):
+                return stage.fn(*args)
+        finally:
+            self.timings[stage.name] = time.perf_counter() - start
+
+    def _degrade(self, stage, reason):
+        if not stage.optional:
+            raise reason if isinstance(reason, BaseException) else TimeoutError(
+                f"Stage {stage.name} timed out after {stage.timeout}s")
+        self.degraded[stage.name] = reason
+        if self.trace is not None:
+            self.trace.mark(stage.name, 'timeout' if reason == 'timeout' else 'error')
+        self.results[stage.name] = stage.default
+
+    def run(self):
+        pending = dict(self.stages)
+        running = {}    # future -> stage
+
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(d in self.results for d in stage.deps):
+                    args = [self.results[d] for d in stage.deps]
+                    running[self.pool.submit(self._timed, stage, args)] = stage
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Stages {sorted(pending)} have circular dependencies")
+
+            # sleep until a stage finishes or the nearest deadline passes; a timed
+            # stage still queued has no deadline yet, check again shortly
+            now = time.perf_counter()
+            deadlines = []
+            for stage in running.values():
+                if stage.timeout is not None:
+                    started = self.started.get(stage.name)
+                    deadlines.append(0.05 if started is None else started + stage.timeout - now)
+            done, _ = wait(list(running), timeout=max(0, min(deadlines)) if deadlines else None,
+                           return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    self.results[stage.name] = future.result()
+                except Exception as e:
+                    self._degrade(stage, e)
+
+            now = time.perf_counter()
+            for future, stage in list(running.items()):
+                started = self.started.get(stage.name)
+                if stage.timeout is not None and started is not None and now - started >= stage.timeout:
+                    # leave the thread to finish on its own, nobody waits for it
+                    running.pop(future)
+                    self.timings[stage.name] = now - started
+                    self._degrade(stage, 'timeout')
+
+        return self.results
+
+
+def run_stages(stages, pool=None):
+    scheduler = StageScheduler(stages, pool)
+    scheduler.run()
+    return scheduler
@@ -0,0 +1,231 @@
+#### ------ Per-stage tracing of a chat turn ------ ####
+#
+# Every question is traced as a tree of spans tagged with SESSION_ID and
+# QUERY_SEQ: a root 'turn' span, one span per stage (rewrite, snowdoc_search,
+# embed, vector_search, presign, summary, complete, log_write, ...), each with
+# its wall clock, the SQL statements issued from it and the tokens and credits
+# it spent. SQL is counted by wrapping the Snowpark session in TracedSession,
+# which charges each statement to the innermost open span of the calling
+# thread. Stages running on the stage pool get their span from StageScheduler.
+#
+# Finished traces go to CHAT_TRACE through TraceWriter, batched in the
+# background like CHAT_HISTORY_LOG.
+
+import contextlib
+import itertools
+import json
+import threading
+import time
+
+from log_writer import BatchWriter, client_timestamp
+from queries import run
+
+
+TRACE_COLUMNS = ["TIMESTAMP", "SESSION_ID", "QUERY_SEQ", "SPAN_ID", "PARENT_ID", "STAGE",
+                 "START_MS", "DURATION_MS", "SQL_COUNT", "TOKENS", "CREDITS", "MODEL", "STATUS"]
+
+_local = threading.local()
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+def current_span():
+    spans = getattr(_local, "spans", None)
+    return spans[-1] if spans else None
+
+
+class Span:
+
+    def __init__(self, trace, span_id, name, parent):
+        self.trace = trace
+        self.span_id = span_id
+        self.name = name
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.duration = None     # seconds, None while running
+        self.sql_count = 0
+        self.tokens = 0
+        self.credits = 0.0
+        self.model = None
+        self.status = None       # 'ok', 'error' or 'timeout'
+
+    def add_tokens(self, tokens, model):
+        # credits at the model's rate in the trace's credit table, 0 for unlisted models
+        tokens = tokens or 0
+        with self.trace._lock:
+            self.tokens += tokens
+            self.credits += tokens * self.trace.credit_table.get(model, 0) / 1000000
+            self.model = model
+
+    def row(self):
+        t = self.trace
+        return {"TIMESTAMP": t.timestamp, "SESSION_ID": t.session_id, "QUERY_SEQ": t.query_seq,
+                "SPAN_ID": self.span_id, "PARENT_ID": self.parent.span_id if self.parent else None,
+                "STAGE": self.name,
+                "START_MS": round((self.start - t.start) * 1000, 1),
+                "DURATION_MS": None if self.duration is None else round(self.duration * 1000, 1),
+                "SQL_COUNT": self.sql_count, "TOKENS": self.tokens,
+                "CREDITS": self.credits, "MODEL": self.model,
+                "STATUS": self.status or "running"}
+
+
+class Trace:
+
+    def __init__(self, session_id, query_seq, credit_table=None):
+        self.session_id = session_id
+        self.query_seq = query_seq
+        self.credit_table = credit_table or {}
+        self.timestamp = client_timestamp()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.root = None
+        self._root_span = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, parent=None):
+        # parent defaults to the innermost open span of this thread
+        if parent is None:
+            parent = current_span() if current_trace() is self else self.root
+        with self._lock:
+            span = Span(self, next(self._ids), name, parent)
+            self.spans.append(span)
+
+        saved = (getattr(_local, "trace", None), getattr(_local, "spans", None))
+        _local.trace = self
+        _local.spans = (saved[1] if saved[0] is self and saved[1] else []) + [span]
+        try:
+            yield span
+        except BaseException:
+            span.status = span.status or "error"
+            raise
+        finally:
+            span.duration = time.perf_counter() - span.start
+            span.status = span.status or "ok"
+            _local.trace, _local.spans = saved
+
+    def begin(self):
+        self._root_span = self.span("turn")
+        self.root = self._root_span.__enter__()
+        return self
+
+    def finish(self):
+        if self._root_span is not None:
+            self._root_span.__exit__(None, None, None)
+            self._root_span = None
+        return self
+
+    def mark(self, name, status):
+        # e.g. a stage the scheduler gave up on; its span ends whenever the thread does
+        with self._lock:
+            for span in self.spans:
+                if span.name == name and span.status is None:
+                    span.status = status
+
+    #### ------ results ------ ####
+
+    @property
+    def total_secs(self):
+        if self.root is not None and self.root.duration is not None:
+            return self.root.duration
+        return time.perf_counter() - self.start
+
+    @property
+    def sql_count(self):
+        return sum(s.sql_count for s in self.spans)
+
+    @property
+    def tokens(self):
+        return sum(s.tokens for s in self.spans)
+
+    @property
+    def credits(self):
+        return sum(s.credits for s in self.spans)
+
+    def rows(self):
+        with self._lock:
+            return [span.row() for span in self.spans]
+
+    def breakdown(self):
+        # one line per span in start order, for the latency panel
+        def depth(span):
+            d = 0
+            while span.parent is not None:
+                span, d = span.parent, d + 1
+            return d
+
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        return [{"stage": "  " * depth(s) + s.name,
+                 "start_ms": round((s.start - self.start) * 1000),
+                 "ms": None if s.duration is None else round(s.duration * 1000),
+                 "sql": s.sql_count,
+                 "tokens": s.tokens,
+                 "credits": round(s.credits, 6),
+                 "status": s.status or "running"}
+                for s in spans]
+
+
+def start_trace(session_id, query_seq, credit_table=None):
+    # open a trace and its root 'turn' span on this thread, until trace.finish()
+    return Trace(session_id, query_seq, credit_table).begin()
+
+
+@contextlib.contextmanager
+def trace_span(name):
+    # a span of the current trace, or nothing when no trace is open
+    trace = current_trace()
+    if trace is None:
+        yield None
+    else:
+        with trace.span(name) as s:
+            yield s
+
+
+def add_tokens(tokens, model):
+    # charge tokens to the innermost open span, if any
+    s = current_span()
+    if s is not None:
+        s.add_tokens(tokens, model)
+
+
+class TracedSession:
+# Snowpark session wrapper that counts statements per span; everything else passes through
+
+    def __init__(self, session):
+        self._session = session
+
+    def sql(self, query, params=None):
+        s = current_span()
+        if s is not None:
+            with s.trace._lock:
+                s.sql_count += 1
+        if params is None:
+            return self._session.sql(query)
+        return self._session.sql(query, params=params)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class TraceWriter(BatchWriter):
+
+    thread_name = "chat-trace-writer"
+
+    def __init__(self, session, table="CHAT_TRACE", max_batch=200,
+                 flush_secs=5, max_retries=3):
+        super().__init__(session, table, max_batch, flush_secs, max_retries)
+
+    def write_trace(self, trace):
+        for row in trace.rows():
+            self._put(row)
+
+    def _key(self, item):
+        return (item["SESSION_ID"], item["QUERY_SEQ"], item["SPAN_ID"])
+
+    def _write(self, rows):
+        source = json.dumps([[row.get(col) for col in TRACE_COLUMNS] for row in rows])
+        run(self.session, "trace_insert", source, table=self.table)
@@ -0,0 +1,268 @@
+#### ------ In-process vector index over docs_chunks_table ------ ####
+#
+# Loads CHUNK_VEC / CHUNK / RELATIVE_PATH once into a contiguous NumPy matrix
+# and answers top-k cosine similarity in memory, so a question no longer needs
+# a query_vec table and a full cross join in the warehouse.
+#
+#   storage:  'float16' (default) or 'int8' (per row scale), optionally
+#             memory-mapped from a local .npy file
+#   ivf:      ivf_lists > 0 clusters the vectors with k-means and only scans
+#             the ivf_probes closest lists per question
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from queries import run
+
+
+EMBED_DIM = 768
+SCAN_BLOCK = 8192     # rows upcast to float32 at a time while scanning
+
+
+def parse_vector(value):
+    # VECTOR::ARRAY comes back from Snowpark as a JSON string, VECTOR as a list
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def normalize(vecs):
+    vecs = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vecs / norms
+
+
+def kmeans(vecs, n_clusters, n_iter=10, seed=0):
+    # spherical k-means on unit vectors, good enough to bucket chunks for IVF
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vecs))
+    centroids = vecs[rng.choice(len(vecs), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = np.argmax(vecs @ centroids.T, axis=1)
+        for c in range(n_clusters):
+            members = vecs[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    assign = np.argmax(vecs @ centroids.T, axis=1)
+    return centroids, assign
+
+
+class VectorIndex:
+
+    def __init__(self, session, table='docs_chunks_table', dtype='float16',
+                 mmap_path=None, ivf_lists=0, ivf_probes=4, refresh_secs=300):
+        if dtype not in ('float16', 'int8'):
+            raise ValueError(f"Unsupported index dtype: {dtype}")
+        self.session = session
+        self.table = table
+        self.dtype = dtype
+        self.mmap_path = mmap_path
+        self.ivf_lists = ivf_lists
+        self.ivf_probes = ivf_probes
+        self.refresh_secs = refresh_secs
+
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        self._checked_at = 0.0
+        self._watermark = None
+        self._trained_size = 0
+        self._reloading = False
+        # everything search() reads is swapped in as one dict so concurrent
+        # users never see a half refreshed index
+        self._state = self._empty_state()
+
+    def __len__(self):
+        return len(self._state["chunks"])
+
+    #### ------ loading ------ ####
+
+    def _empty_state(self):
+        return {"matrix": np.zeros((0, EMBED_DIM), dtype=self.dtype),
+                "scales": np.zeros(0, dtype=np.float32),
+                "chunks": [], "paths": [],
+                "centroids": None, "lists": None}
+
+    def _fetch(self, since=None):
+        if since is None:
+            rows = run(self.session, "index_load", method="to_local_iterator", table=self.table)
+        else:
+            rows = run(self.session, "index_load_since", str(since),
+                       method="to_local_iterator", table=self.table)
+        vecs, chunks, paths, watermark = [], [], [], None
+        for row in rows:
+            vecs.append(parse_vector(row["CHUNK_VEC"]))
+            chunks.append(row["CHUNK"])
+            paths.append(row["RELATIVE_PATH"])
+            if row["CREATED_AT"] is not None and (watermark is None or row["CREATED_AT"] > watermark):
+                watermark = row["CREATED_AT"]
+        vecs = normalize(np.vstack(vecs)) if vecs else np.zeros((0, EMBED_DIM), dtype=np.float32)
+        return vecs, chunks, paths, watermark
+
+    def _encode(self, vecs):
+        if self.dtype == 'float16':
+            return vecs.astype(np.float16), np.ones(len(vecs), dtype=np.float32)
+        scales = np.abs(vecs).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vecs / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def _decode(self, matrix, scales):
+        return matrix.astype(np.float32) * scales[:, None]
+
+    def _store(self, matrix):
+        # keep the matrix contiguous, and on disk when a mmap path is configured
+        matrix = np.ascontiguousarray(matrix)
+        if not self.mmap_path:
+            return matrix
+        tmp_path = self.mmap_path + ".tmp.npy"
+        np.save(tmp_path, matrix)
+        os.replace(tmp_path, self.mmap_path)
+        return np.load(self.mmap_path, mmap_mode='r')
+
+    def _build_ivf(self, matrix, scales):
+        if not self.ivf_lists or len(matrix) < self.ivf_lists * 4:
+            return None, None
+        centroids, assign = kmeans(self._decode(matrix, scales), self.ivf_lists)
+        lists = [np.flatnonzero(assign == c) for c in range(len(centroids))]
+        self._trained_size = len(matrix)
+        return centroids, lists
+
+    def load(self):
+        # full (re)load of the table into memory
+        with self._lock:
+            vecs, chunks, paths, watermark = self._fetch()
+            matrix, scales = self._encode(vecs)
+            matrix = self._store(matrix)
+            centroids, lists = self._build_ivf(matrix, scales)
+            self._state = {"matrix": matrix, "scales": scales,
+                           "chunks": chunks, "paths": paths,
+                           "centroids": centroids, "lists": lists}
+            self._watermark = watermark
+            self._checked_at = time.time()
+        return self
+
+    def _reload_async(self):
+        # full reload off the question's path; search() serves the current state until the swap
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+
+        def reload():
+            try:
+                self.load()
+            finally:
+                self._reloading = False
+
+        # imported here so the procedures that stage this file (partition_docs,
+        # warm_answers) don't need the app's runtime modules
+        from stages import get_background_pool
+        get_background_pool().submit(reload)
+
+    def refresh(self, force=False):
+        # pick up rows that landed since the last load, at most every refresh_secs.
+        # Appends are applied here, anything needing a full reload happens in the background
+        if self._reloading:
+            return 0
+        with self._check_lock:
+            # one session per period runs the stats query
+            if not force and time.time() - self._checked_at < self.refresh_secs:
+                return 0
+            self._checked_at = time.time()
+
+        row = run(self.session, "index_stats", table=self.table)[0]
+
+        if row["N"] == len(self) and row["MAX_TS"] == self._watermark:
+            return 0
+        if row["N"] < len(self) or self._watermark is None:
+            # rows were deleted or replaced, an append is not enough
+            self._reload_async()
+            return 0
+
+        with self._lock:
+            # another session may have applied the same rows while this one waited
+            state = self._state
+            current = len(state["chunks"])
+            if current >= row["N"] and self._watermark is not None and (
+                    row["MAX_TS"] is None or self._watermark >= row["MAX_TS"]):
+                return 0
+
+            vecs, chunks, paths, watermark = self._fetch(since=self._watermark)
+            # rows without a newer created_at changed underneath us when the
+            # counts do not add up, fall back to a full load below
+            stale = current + len(chunks) != row["N"]
+            added = 0
+
+            if chunks and not stale:
+                new_matrix, new_scales = self._encode(vecs)
+                matrix = self._store(np.concatenate([np.asarray(state["matrix"]), new_matrix]))
+                scales = np.concatenate([state["scales"], new_scales])
+                centroids, lists = state["centroids"], state["lists"]
+
+                if self.ivf_lists and (centroids is None or len(matrix) > 2 * self._trained_size):
+                    centroids, lists = self._build_ivf(matrix, scales)
+                elif centroids is not None:
+                    assign = np.argmax(vecs @ centroids.T, axis=1)
+                    offsets = np.arange(current, current + len(chunks))
+                    lists = [np.concatenate([members, offsets[assign == c]])
+                             for c, members in enumerate(lists)]
+
+                self._state = {"matrix": matrix, "scales": scales,
+                               "chunks": state["chunks"] + chunks,
+                               "paths": state["paths"] + paths,
+                               "centroids": centroids, "lists": lists}
+                self._watermark = watermark
+                added = len(chunks)
+
+        if stale:
+            self._reload_async()
+        return added
+
+    #### ------ search ------ ####
+
+    def _scores(self, state, q, rows=None):
+        matrix, scales = state["matrix"], state["scales"]
+        if rows is not None:
+            matrix, scales = matrix[rows], scales[rows]
+        scores = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), SCAN_BLOCK):
+            block = matrix[start:start + SCAN_BLOCK].astype(np.float32)
+            scores[start:start + SCAN_BLOCK] = block @ q
+        return scores * scales
+
+    def search(self, qvec, k, with_vectors=False):
+        # returns the k most similar chunks, best first, as
+        # a DataFrame with CHUNK, RELATIVE_PATH and DISTANCE (cosine similarity),
+        # and VECTOR (the chunk embedding) with_vectors
+        state = self._state
+        if not state["chunks"] or k <= 0:
+            return pd.DataFrame(columns=["CHUNK", "RELATIVE_PATH", "DISTANCE"] + (["VECTOR"] if with_vectors else []))
+
+        q = normalize(parse_vector(qvec))
+
+        if state["centroids"] is not None:
+            probes = np.argsort(-(state["centroids"] @ q))[:self.ivf_probes]
+            rows = np.concatenate([state["lists"][c] for c in probes])
+            if len(rows) < k:
+                rows = None
+        else:
+            rows = None
+
+        scores = self._scores(state, q, rows)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        ids = rows[top] if rows is not None else top
+
+        df = pd.DataFrame({"CHUNK": [state["chunks"][i] for i in ids],
+                           "RELATIVE_PATH": [state["paths"][i] for i in ids],
+                           "DISTANCE": scores[top]})
+        if with_vectors:
+            df["VECTOR"] = list(self._decode(state["matrix"][ids], state["scales"][ids]))
+        return df
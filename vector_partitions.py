@@ -0,0 +1,71 @@
+#### ------ Partitioned vector search in Snowflake ------ ####
+#
+# For knowledge bases too large to keep in the app's memory (vector_index.py),
+# the search runs in Snowflake over an IVF style layout:
+#
+#   DOCS_CHUNK_CENTROIDS   k-means centroids of CHUNK_VEC (a sample of it)
+#   CLUSTER_ID             the nearest centroid of each chunk in DOCS_CHUNKS_TABLE,
+#                          which is clustered by it so a partition is a few
+#                          micro-partitions
+#
+# A question is compared with the centroids first, and only the chunks of the
+# nearest `probes` partitions (plus any chunk not assigned yet) are scored and
+# sorted, instead of every row. partition_docs is the procedure that trains and
+# assigns, called by ingest_docs after every load (see setup.sql).
+
+import json
+
+import numpy as np
+import pandas as pd
+
+from queries import run
+from vector_index import kmeans, normalize, parse_vector
+
+
+def train_partitions(session, lists, sample=20000, table='DOCS_CHUNKS_TABLE',
+                     centroids='DOCS_CHUNK_CENTROIDS'):
+    # k-means over a sample of the chunk vectors, replaces the centroids
+    rows = run(session, 'partition_sample', sample, table=table)
+    if not rows:
+        return 0
+    vecs = normalize(np.vstack([parse_vector(row.CHUNK_VEC) for row in rows]))
+    found, _ = kmeans(vecs, lists)
+    trained_size = run(session, 'partition_stats', table=table, centroids=centroids)[0].CHUNKS
+    run(session, 'partition_centroids_replace', trained_size,
+        json.dumps([[i, c.tolist()] for i, c in enumerate(found)]), centroids=centroids)
+    return len(found)
+
+
+def partition_docs(session, lists=0, rebuild=False, sample=20000, table='DOCS_CHUNKS_TABLE',
+                   centroids='DOCS_CHUNK_CENTROIDS'):
+    # stored procedure handler. lists > 0 or rebuild (re)trains the centroids and
+    # reassigns every chunk; otherwise only new chunks are assigned, and the centroids
+    # are retrained with as many lists once the table has doubled since training
+    stats = run(session, 'partition_stats', table=table, centroids=centroids)[0]
+    lists = lists or stats.LISTS
+    if not lists:
+        return "not partitioned, call partition_docs(<lists>, true) to set it up"
+
+    if rebuild or lists != stats.LISTS or stats.CHUNKS > 2 * (stats.TRAINED_SIZE or 0):
+        lists = train_partitions(session, lists, sample, table, centroids)
+        assigned = run(session, 'partition_assign', True, table=table, centroids=centroids)
+        action = f"trained {lists} partitions"
+    else:
+        assigned = run(session, 'partition_assign', False, table=table, centroids=centroids)
+        action = f"kept {lists} partitions"
+    return f"{action}, assigned {assigned[0][0] if assigned else 0} chunks"
+
+
+def search_partitions(session, qvec, k, probes=8, table='DOCS_CHUNKS_TABLE',
+                      centroids='DOCS_CHUNK_CENTROIDS'):
+    # same shape as VectorIndex.search(..., with_vectors=True); probes=0 scans every chunk
+    qvec = json.dumps(normalize(parse_vector(qvec)).tolist())
+    if probes > 0:
+        rows = run(session, 'vector_search_probe', qvec, probes, qvec, k,
+                   table=table, centroids=centroids)
+    else:
+        rows = run(session, 'vector_search_full', qvec, k, table=table)
+    return pd.DataFrame({"CHUNK": [row.CHUNK for row in rows],
+                         "RELATIVE_PATH": [row.RELATIVE_PATH for row in rows],
+                         "DISTANCE": np.array([row.DISTANCE for row in rows], dtype=np.float32),
+                         "VECTOR": [parse_vector(row.VECTOR) for row in rows]})
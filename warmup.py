@@ -0,0 +1,155 @@
+#### ------ Answer warm-up from CHAT_HISTORY_LOG ------ ####
+#
+# The questions everyone asks are answered ahead of time, so the first user of
+# the day doesn't pay the cold path for them:
+#
+#   1. recent questions  the most asked questions of the last few days in
+#                        CHAT_HISTORY_LOG with their Yes / No feedback,
+#                        embedded in the same statement
+#   2. cluster           paraphrases grouped by cosine similarity, clusters
+#                        ranked by how often their questions were asked
+#   3. answer            the top clusters answered for each model with the
+#                        set-based batch statements (see batch_qa.py), then
+#                        published to PRECOMPUTED_ANSWERS, replacing the
+#                        previous run
+#
+# A cluster is answered through its best rated question: one with Yes and no No
+# feedback first, the most asked one otherwise. The app loads
+# PRECOMPUTED_ANSWERS into its answer cache and finds them there before running
+# the pipeline (precomputed_table in app.py).
+#
+# Runs as the warm_answers procedure from a daily task (see setup.sql), or by hand:
+#
+#   python warmup.py --top-n 20 --days 7
+#   python warmup.py --models mistral-7b mistral-large --connection my_conn
+
+import argparse
+import json
+import sys
+import time
+from uuid import uuid4
+
+import numpy as np
+
+from prompt_budget import PROMPT_INSTRUCTIONS
+from queries import run
+from vector_index import normalize, parse_vector
+
+
+MODELS = ['mistral-7b', 'mixtral-8x7b', 'reka-flash', 'mistral-large', 'llama3.1-70b', 'llama3.1-405b']   # as offered in app.py
+
+
+def recent_questions(session, days=7, max_questions=2000, log_table='CHAT_HISTORY_LOG'):
+    rows = run(session, 'warmup_recent_questions', days, max_questions, log_table=log_table)
+    return [{"question": row.QUESTION, "asked": row.ASKED, "positive": row.POSITIVE,
+             "negative": row.NEGATIVE, "qvec": normalize(parse_vector(row.QVEC))}
+            for row in rows]
+
+
+def cluster_questions(questions, threshold=0.9):
+    # greedy, most asked question first: a question joins the cluster of the most
+    # similar leader above threshold, or leads a new one. Most asked clusters first
+    clusters, leaders = [], []
+    for q in sorted(questions, key=lambda q: q["asked"], reverse=True):
+        if leaders:
+            sims = np.stack(leaders) @ q["qvec"]
+            best = int(np.argmax(sims))
+            if sims[best] >= threshold:
+                clusters[best]["members"].append(q)
+                continue
+        clusters.append({"members": [q]})
+        leaders.append(q["qvec"])
+
+    for c in clusters:
+        c["asked"] = sum(q["asked"] for q in c["members"])
+        c["positive"] = sum(q["positive"] for q in c["members"])
+    return sorted(clusters, key=lambda c: (c["asked"], c["positive"]), reverse=True)
+
+
+def representative(cluster):
+    # the best rated question of the cluster, the most asked one between equals
+    return max(cluster["members"],
+               key=lambda q: (q["positive"] > 0 and q["negative"] == 0,
+                              q["positive"] - q["negative"], q["asked"]))
+
+
+def run_warmup(session, models=MODELS, top_n=20, days=7, threshold=0.9, max_questions=2000,
+               num_chunks=3, context_chars=12000, log_table='CHAT_HISTORY_LOG',
+               chunks_table='DOCS_CHUNKS_TABLE', batch_table='BATCH_ANSWERS',
+               table='PRECOMPUTED_ANSWERS'):
+    # top_n clusters x models COMPLETE calls; the answers also stay in batch_table under run_id
+    run_id = f"warmup-{uuid4()}"
+    timings = {}
+
+    start = time.perf_counter()
+    clusters = cluster_questions(recent_questions(session, days, max_questions, log_table), threshold)
+    top = clusters[:top_n]
+    timings['cluster_secs'] = time.perf_counter() - start
+    if not top:
+        # nothing asked lately, keep the previous answers
+        return {"run_id": run_id, "questions": 0, "clusters": 0, "answers": 0}
+
+    picked = [(str(rank), representative(c)) for rank, c in enumerate(top, start=1)]
+
+    start = time.perf_counter()
+    run(session, 'batch_load_rows', json.dumps([[qid, q["question"]] for qid, q in picked]))
+    run(session, 'batch_retrieve', num_chunks, chunks_table=chunks_table)
+    timings['retrieve_secs'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for model in models:
+        run(session, 'batch_complete', context_chars, model, PROMPT_INSTRUCTIONS, run_id, model,
+            table=batch_table)
+    timings['complete_secs'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stats = json.dumps([[qid, c["asked"], c["positive"]] for (qid, _), c in zip(picked, top)])
+    published = run(session, 'precomputed_publish', stats, run_id, table=table, batch_table=batch_table)
+    run(session, 'precomputed_prune', run_id, table=table)
+    timings['publish_secs'] = time.perf_counter() - start
+
+    return {"run_id": run_id,
+            "questions": sum(len(c["members"]) for c in clusters),
+            "clusters": len(clusters),
+            "answers": published[0][0] if published else 0,
+            "top_questions": [q["question"] for _, q in picked],
+            **{k: round(v, 3) for k, v in timings.items()}}
+
+
+def warm_answers(session, models=None, top_n=20, days=7):
+    # stored procedure handler
+    return run_warmup(session, models=models or MODELS, top_n=top_n, days=days)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute answers to the most asked questions of CHAT_HISTORY_LOG")
+    parser.add_argument("--models", nargs="+", default=MODELS)
+    parser.add_argument("--top-n", type=int, default=20, help="clusters of questions answered")
+    parser.add_argument("--days", type=int, default=7, help="questions logged in the last days")
+    parser.add_argument("--threshold", type=float, default=0.9, help="cosine similarity of questions in a cluster")
+    parser.add_argument("--max-questions", type=int, default=2000, help="most asked questions clustered")
+    parser.add_argument("--num-chunks", type=int, default=3)
+    parser.add_argument("--context-chars", type=int, default=12000, help="knowledge base context per question")
+    parser.add_argument("--log-table", default="CHAT_HISTORY_LOG")
+    parser.add_argument("--chunks-table", default="DOCS_CHUNKS_TABLE")
+    parser.add_argument("--batch-table", default="BATCH_ANSWERS")
+    parser.add_argument("--table", default="PRECOMPUTED_ANSWERS")
+    parser.add_argument("--connection", help="connection name in connections.toml (the default connection otherwise)")
+    args = parser.parse_args(argv)
+
+    from snowflake.snowpark import Session
+    builder = Session.builder
+    if args.connection:
+        builder = builder.config("connection_name", args.connection)
+    session = builder.create()
+
+    result = run_warmup(session, models=args.models, top_n=args.top_n, days=args.days,
+                        threshold=args.threshold, max_questions=args.max_questions,
+                        num_chunks=args.num_chunks, context_chars=args.context_chars,
+                        log_table=args.log_table, chunks_table=args.chunks_table,
+                        batch_table=args.batch_table, table=args.table)
+    sys.stdout.write(json.dumps(result, indent=2, default=str) + "\n")
+
+
+if __name__ == "__main__":
+    main()